@@ -3,15 +3,23 @@ import os
 
 from provisioning.aws.services import Service
 from provisioning.aws.aws_engines import UbuntuSystemD
+from cwlrun import metrics
 
 log = logging.getLogger('cloud_provision')
 log.setLevel(logging.INFO)
 console = logging.StreamHandler()
 log.addHandler(console)
 
+# port to serve the provisioning metrics on (the instance counters of
+# provisioning.aws.ec2_instance), while instances are provisioned
+METRICS_PORT = os.environ.get('CLOUD_PROVISION_METRICS_PORT')
+
 
 def main():
 
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+
     # assumes file ~/.aws/credentials contains access_key_id and secrect_key_id fields
     # user must specify av_zone
     myenv = Service('eu-west-1a')
@@ -0,0 +1,77 @@
+"""
+Compares serial output digesting with DigestPool on synthetic outputs.
+
+    python benchmarks/bench_digest.py [--files 500] [--size 1024] [--workers N] [--dir DIR]
+
+'--size' is in MB: the default writes 500 x 1GB files, make sure '--dir' has
+room for them. Files are left in place, so that following runs reuse them.
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun'))
+
+from io_utilities import file_checksum
+from digest import DigestPool
+
+BLOCK = 1024 * 1024
+
+
+def make_outputs(directory, files, size):
+    paths = {}
+    block = os.urandom(BLOCK)
+    for i in range(files):
+        path = os.path.join(directory, "output_%04d.bin" % i)
+        if not os.path.exists(path) or os.path.getsize(path) != size * BLOCK:
+            with open(path, 'wb') as handle:
+                for j in range(size):
+                    handle.write(block)
+        paths[i] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--dir", default="/tmp/bench_digest")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    paths = make_outputs(args.dir, args.files, args.size)
+    total = args.files * args.size
+
+    pool = DigestPool(args.workers)
+
+    started = time.time()
+    serial = dict((key, file_checksum(path)) for key, path in paths.items())
+    elapsed = time.time() - started
+    print("serial: %d files, %.2fs, %.1f MB/s" % (args.files, elapsed, total / elapsed))
+
+    done = threading.Event()
+    result = {}
+
+    def callback(checksums):
+        result.update(checksums)
+        done.set()
+
+    started = time.time()
+    pool.checksums(paths, callback)
+    while not done.is_set():
+        done.wait(1)
+    elapsed = time.time() - started
+    print("pool (%d workers): %d files, %.2fs, %.1f MB/s" % (
+        args.workers, args.files, elapsed, total / elapsed))
+
+    assert result == serial
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Measures the per-job cost, in the driver, of the debug logging done by a
+LocalWorkflowJob (path mapping, run, output collection and globs), with the
+'cloud_provision' logger at INFO level: the old eager pformat() calls against
+the lazy ones of the logs module.
+
+    python benchmarks/bench_logging.py [--jobs 2000] [--inputs 20] [--level INFO]
+
+'--inputs' is the number of input files of each job, which is what makes
+CWL specs and job orders large.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from pprint import pformat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun'))
+
+import logs
+
+
+def make_job(inputs):
+    spec = {
+        'id': 'file:///workflows/align.cwl',
+        'class': 'CommandLineTool',
+        'baseCommand': ['bwa', 'mem'],
+        'inputs': [{'id': 'file:///workflows/align.cwl#in_%d' % i, 'type': 'File',
+                    'inputBinding': {'position': i}} for i in range(inputs)],
+        'outputs': [{'id': 'file:///workflows/align.cwl#out', 'type': 'File',
+                     'outputBinding': {'glob': 'out.bam'}}],
+        'requirements': [{'class': 'DockerRequirement', 'dockerPull': 'biocontainers/bwa'}]
+    }
+    joborder = dict(('in_%d' % i, {
+        'class': 'File', 'location': 'file:///data/sample/reads_%d.fastq' % i,
+        'basename': 'reads_%d.fastq' % i, 'size': 1 << 30,
+        'checksum': 'sha1$' + '0' * 40
+    }) for i in range(inputs))
+    return spec, joborder
+
+
+def eager(log, spec, joborder):
+    referenced = list(joborder.values())
+    log.debug("PATHMAPPER: " + pformat(referenced))
+    for src in referenced:
+        log.debug('SOURCE: ' + str(src))
+        log.debug("Staging %s to shared %s" % (src['location'], '/store'))
+        log.debug("Staged %s as %s with %s" % (src['location'], 'cas/x', 'reflink'))
+    log.debug('PATHMAP: ' + pformat(joborder))
+    log.debug('SPEC: ' + pformat(spec))
+    log.debug('JOBORDER: ' + pformat(joborder))
+    log.debug('GENERATEFILES: ' + pformat({'class': 'Directory', 'listing': []}))
+    log.debug('SPEC_OUTPUTS: ' + pformat(spec['outputs']))
+    log.debug('PRE_OUTPUTS: ' + pformat({'out': 'out.bam'}))
+    log.debug("OPERATION: " + pformat({'jobId': 'task-1'}))
+    log.debug('OUTPUTS: ' + pformat({'out': 'out.bam'}))
+    log.debug("ABSOLUTE: " + pformat('/store/job/work/out.bam'))
+    log.debug("GLOBS: " + pformat(['/store/job/work/out.bam']))
+    log.debug('GLOB: ' + pformat(['/store/job/work/out.bam']))
+
+
+def lazy(log, spec, joborder):
+    referenced = list(joborder.values())
+    log.debug('PATHMAPPER: %s', logs.Pretty(referenced))
+    for src in referenced:
+        log.debug('SOURCE: %s', src)
+        log.debug_event('staging', source=src['location'], store='/store')
+        log.debug_event('staged', source=src['location'], name='cas/x', strategy='reflink')
+    log.debug('PATHMAP: %s', logs.Pretty(joborder))
+    log.debug('SPEC: %s', logs.Pretty(spec))
+    log.debug('JOBORDER: %s', logs.Pretty(joborder))
+    log.debug('GENERATEFILES: %s', logs.Pretty({'class': 'Directory', 'listing': []}))
+    log.debug('SPEC_OUTPUTS: %s', logs.Pretty(spec['outputs']))
+    log.debug('PRE_OUTPUTS: %s', logs.Pretty({'out': 'out.bam'}))
+    log.debug('OPERATION: %s', logs.Pretty({'jobId': 'task-1'}))
+    log.debug('OUTPUTS: %s', logs.Pretty({'out': 'out.bam'}))
+    log.debug_event('glob', pattern='out.bam', absolute='/store/job/work/out.bam',
+                    globs=['/store/job/work/out.bam'])
+    log.debug('GLOB: %s', logs.Pretty(['/store/job/work/out.bam']))
+
+
+def measure(fn, log, jobs, spec, joborder):
+    started = time.clock()
+    for i in range(jobs):
+        fn(log, spec, joborder)
+    return time.clock() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--inputs", type=int, default=20)
+    parser.add_argument("--level", default="INFO")
+    args = parser.parse_args()
+
+    base = logging.getLogger('cloud_provision')
+    base.setLevel(getattr(logging, args.level.upper()))
+    base.addHandler(logging.NullHandler())
+    base.propagate = False
+
+    spec, joborder = make_job(args.inputs)
+    before = measure(eager, base, args.jobs, spec, joborder)
+    after = measure(lazy, logs.get_logger(), args.jobs, spec, joborder)
+    print("%d jobs, %d inputs each, %s level" % (args.jobs, args.inputs, args.level.upper()))
+    print("eager pformat: %8.1f us/job" % (before / args.jobs * 1e6))
+    print("lazy logs:     %8.1f us/job" % (after / args.jobs * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Measures submit and poll latency of LocalService against a local stub of the
+task service, with a number of concurrent jobs.
+
+    python benchmarks/bench_service.py [--jobs 1000] [--threads 8] [--no-session]
+
+'--no-session' uses the module-level requests.post/get (a new connection per
+request), for comparison.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from itertools import count
+from Queue import Queue
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun'))
+
+from local_wf import LocalService
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    ids = count()
+
+    def reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        self.reply({'value': str(next(self.ids))})
+
+    def do_GET(self):
+        if self.path == "/v1/jobs-service":
+            self.reply({'storageConfig': {'storageType': 'sharedFile', 'baseDir': '/tmp'}})
+        else:
+            self.reply({'jobId': self.path.split('/')[-1], 'state': 'Complete'})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SessionlessService(LocalService):
+    def submit(self, task):
+        return requests.post("%s/v1/jobs" % (self.addr), json=task).json()['value']
+
+    def get_job(self, job_id):
+        return requests.get("%s/v1/jobs/%s" % (self.addr, job_id)).json()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--no-session", action="store_true")
+    args = parser.parse_args()
+
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    addr = "http://127.0.0.1:%d" % server.server_address[1]
+    cls = SessionlessService if args.no_session else LocalService
+    service = cls(addr, pool_size=args.threads)
+
+    task = {'name': 'bench', 'docker': [{'cmd': ['true'], 'imageName': 'busybox'}]}
+    submits = []
+    polls = []
+    jobs = Queue()
+    for i in range(args.jobs):
+        jobs.put(i)
+
+    def worker():
+        while not jobs.empty():
+            try:
+                jobs.get_nowait()
+            except Exception:
+                return
+            start = time.time()
+            job_id = service.submit(task)
+            submits.append(time.time() - start)
+            start = time.time()
+            service.get_job(job_id)
+            polls.append(time.time() - start)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+
+    for name, values in (('submit', submits), ('poll', polls)):
+        print("%s: %s n=%d mean=%.2fms p95=%.2fms" % (
+            cls.__name__, name, len(values),
+            1000 * sum(values) / len(values), 1000 * percentile(values, 0.95)))
+    print("%s: %d jobs in %.2fs" % (cls.__name__, args.jobs, elapsed))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
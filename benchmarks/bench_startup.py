@@ -0,0 +1,78 @@
+"""
+Measures the start-up time of the cwlrun command line: how long a fresh
+interpreter takes to import cwlrun.main and run it with the given arguments
+(by default '--version'), and how many modules that loads.
+
+    python benchmarks/bench_startup.py [--runs 10] [--target 100] [-- ARGS...]
+
+The median wall time is checked against '--target' (in milliseconds): the
+script exits with status 1 if it is missed, so that it can be tracked in CI.
+'python -X importtime' does not exist on Python 2; run with '--verbose' for
+the list of modules imported instead.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+CWLRUN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun')
+
+# median start-up time of 'cwlrun --version' to stay under, in milliseconds
+TARGET_MS = 100
+
+STARTUP = """
+import sys
+sys.path.insert(0, %r)
+import main
+status = main.main(sys.argv[1:])
+sys.stderr.write('MODULES %%d\\n' %% len(sys.modules))
+if %r:
+    sys.stderr.write('\\n'.join(sorted(sys.modules)) + '\\n')
+"""
+
+
+def run_once(args, verbose):
+    started = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-c', STARTUP % (CWLRUN, verbose)] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    out, err = process.communicate()
+    elapsed = time.time() - started
+    modules = None
+    for line in err.splitlines():
+        if line.startswith('MODULES '):
+            modules = int(line.split()[1])
+        elif verbose:
+            print(line)
+    return elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target", type=float, default=TARGET_MS)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("args", nargs="*", default=['--version'])
+    args = parser.parse_args()
+
+    if args.verbose:
+        run_once(args.args, True)
+    times = []
+    for i in range(args.runs):
+        elapsed, modules = run_once(args.args, False)
+        times.append(elapsed)
+    times.sort()
+    median = times[len(times) // 2] * 1000
+    print("cwlrun %s: median %.1f ms (min %.1f ms) over %d runs, %s modules loaded" % (
+        ' '.join(args.args), median, times[0] * 1000, args.runs, modules))
+    if median > args.target:
+        print("target of %.0f ms missed" % (args.target))
+        return 1
+    print("target of %.0f ms met" % (args.target))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
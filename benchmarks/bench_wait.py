@@ -0,0 +1,116 @@
+"""
+Runs a number of fake jobs through WorkFlow.executor() and reports the CPU time
+spent by the driver process while waiting for them to complete.
+
+    python benchmarks/bench_wait.py [--jobs 1000] [--duration 2.0] [--spin] [--poller]
+
+'--spin' uses the old busy loop in wait(), for comparison; '--poller' hands
+the jobs to the shared JobPoller instead of starting one thread per job.
+"""
+import os
+import sys
+import time
+import resource
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun'))
+
+from workflow import WorkFlow
+from monitor import MonitorThread
+
+
+def cpu_time():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    return me.ru_utime + me.ru_stime
+
+
+class FakeMonitor(MonitorThread):
+    def __init__(self, operation, duration, callback):
+        super(FakeMonitor, self).__init__(operation, poll_interval=duration, jitter=0)
+        self.callback = callback
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+        return {'state': 'Complete' if self.polls > 1 else 'Running'}
+
+    def is_done(self, operation):
+        return operation['state'] == 'Complete'
+
+    def complete(self, operation):
+        self.callback({}, 'success')
+
+
+class FakeOperation(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeJob(object):
+    def __init__(self, workflow, id, duration, callback, shared=False):
+        self.workflow = workflow
+        self.shared = shared
+        self.id = id
+        self.duration = duration
+        self.callback = callback
+        self.outdir = None
+
+    def run(self, **kwargs):
+        monitor = FakeMonitor(FakeOperation(self.id), self.duration, self.callback)
+        if self.shared:
+            self.workflow.add_monitor(monitor)
+        else:
+            self.workflow.add_thread(monitor)
+            monitor.start()
+
+
+class FakeTool(object):
+    def __init__(self, workflow, jobs, duration, shared=False):
+        self.workflow = workflow
+        self.shared = shared
+        self.jobs = jobs
+        self.duration = duration
+        self.metadata = {}
+        self.requirements = []
+
+    def job(self, job_order, output_callback, **kwargs):
+        for i in range(self.jobs):
+            yield FakeJob(self.workflow, i, self.duration, output_callback, self.shared)
+
+
+class SpinningWorkFlow(WorkFlow):
+    def wait(self):
+        while True:
+            if all([not t.is_alive() for t in self.threads]):
+                break
+        for t in self.threads:
+            t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--spin", action="store_true")
+    parser.add_argument("--poller", action="store_true")
+    args = parser.parse_args()
+
+    config = {'poll_rate': args.jobs / args.duration}
+    workflow = SpinningWorkFlow(config) if args.spin else WorkFlow(config)
+    tool = FakeTool(workflow, args.jobs, args.duration, args.poller)
+    basedir = tempfile.mkdtemp()
+
+    wall_start = time.time()
+    cpu_start = cpu_time()
+    output, status = workflow.executor(tool, {}, basedir=basedir, rm_tmpdir=True)
+    cpu = cpu_time() - cpu_start
+    wall = time.time() - wall_start
+
+    print("%s: %d jobs, status=%s, wall=%.2fs, driver cpu=%.2fs, threads=%d" % (
+        workflow.__class__.__name__, args.jobs, status, wall, cpu,
+        len(workflow.threads) + len(workflow.poller.threads)))
+
+
+if __name__ == '__main__':
+    main()
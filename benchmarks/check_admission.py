@@ -0,0 +1,180 @@
+"""
+Checks that the admission controller of WorkFlow.executor() bounds the jobs
+in flight and gives their slots back however they end: runs more fake jobs
+than '--slots' through the executor, half of them failing, and checks that
+no more than '--slots' ever ran at once, that every job ran, and that no
+slot is left taken. A job whose run() raises is also checked to release its
+slot.
+
+    python benchmarks/check_admission.py [--jobs 200] [--slots 8] [--duration 0.05] [--timeout 60]
+
+The script exits with status 1 if a check fails, or if a run is not over
+after '--timeout' seconds (as happens when slots leak).
+"""
+import os
+import sys
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun'))
+
+from workflow import WorkFlow
+from monitor import Monitor
+from cwltool.errors import WorkflowException
+
+
+class FakeMonitor(Monitor):
+    def __init__(self, job, duration):
+        super(FakeMonitor, self).__init__({'id': job.name}, poll_interval=duration, jitter=0)
+        self.job = job
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+        return {'state': 'Complete' if self.polls > 1 else 'Running'}
+
+    def is_done(self, operation):
+        return operation['state'] == 'Complete'
+
+    def complete(self, operation):
+        self.job.done()
+
+
+class FakeJob(object):
+    def __init__(self, tool, i, fail=False, broken=False):
+        self.tool = tool
+        self.name = 'job_%d' % i
+        self.spec = {'id': 'file:///check.cwl'}
+        self.requirements = [{'class': 'ResourceRequirement', 'coresMin': 1}]
+        self.hints = []
+        self.outdir = None
+        self.fail = fail
+        self.broken = broken
+        self.output_callback = None
+
+    def run(self, **kwargs):
+        if self.broken:
+            raise RuntimeError('%s cannot be submitted' % (self.name))
+        self.tool.started()
+        self.tool.workflow.add_monitor(FakeMonitor(self, self.tool.duration))
+
+    def done(self):
+        self.tool.stopped()
+        self.output_callback({}, 'permanentFail' if self.fail else 'success')
+        self.tool.workflow.notify_progress()
+
+
+class FakeTool(object):
+    '''
+    Yields 'jobs' jobs (every other one failing, or a single broken one),
+    then None until they are all over, as cwltool does for a scatter.
+    '''
+    def __init__(self, workflow, jobs, duration, broken=False):
+        self.workflow = workflow
+        self.jobs = jobs
+        self.duration = duration
+        self.broken = broken
+        self.metadata = {}
+        self.requirements = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.ran = 0
+        self.over = 0
+
+    def started(self):
+        with self.lock:
+            self.running += 1
+            self.ran += 1
+            self.peak = max(self.peak, self.running)
+
+    def stopped(self):
+        with self.lock:
+            self.running -= 1
+            self.over += 1
+
+    def job(self, job_order, output_callback, **kwargs):
+        statuses = []
+
+        def callback(out, status):
+            statuses.append(status)
+
+        for i in range(self.jobs):
+            job = FakeJob(self, i, fail=i % 2 == 1, broken=self.broken)
+            job.output_callback = callback
+            yield job
+        while len(statuses) < self.jobs:
+            yield None
+        output_callback({}, 'success' if statuses.count('success') == self.jobs else 'permanentFail')
+
+
+def execute(workflow, tool, timeout):
+    '''
+    Runs 'tool' through workflow.executor() and returns its (output, status),
+    or raises what it raised; returns None if it is not over after 'timeout'
+    seconds.
+    '''
+    result = []
+
+    def run():
+        try:
+            result.append(workflow.executor(tool, {}, basedir=tempfile.mkdtemp(), rm_tmpdir=True))
+        except Exception as e:
+            result.append(e)
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    t.join(timeout)
+    if not result:
+        return None
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+
+def check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--slots", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    failures = []
+
+    workflow = WorkFlow({'max_jobs': args.slots, 'poll_rate': 1000})
+    tool = FakeTool(workflow, args.jobs, args.duration)
+    output, status = execute(workflow, tool, args.timeout) or (None, 'stalled')
+    print("%d jobs through %d slots: status=%s, ran=%d, peak in flight=%d, left in flight=%d" % (
+        args.jobs, args.slots, status, tool.ran, tool.peak, workflow.admission.running()))
+    check(failures, tool.ran == args.jobs, 'only %d of %d jobs ran' % (tool.ran, args.jobs))
+    check(failures, tool.over == args.jobs, 'only %d of %d jobs ended' % (tool.over, args.jobs))
+    check(failures, tool.peak <= args.slots,
+          '%d jobs in flight with %d slots' % (tool.peak, args.slots))
+    check(failures, workflow.admission.inflight == {'jobs': 0, 'cores': 0, 'ram': 0},
+          'slots left taken: %s' % (workflow.admission.inflight))
+    check(failures, status == 'permanentFail', 'status is %s with failed jobs' % (status))
+
+    workflow = WorkFlow({'max_jobs': 1})
+    try:
+        execute(workflow, FakeTool(workflow, 1, args.duration, broken=True), args.timeout)
+        failures.append('a job failing to run did not fail the workflow')
+    except WorkflowException:
+        pass
+    print("job raising in run(): left in flight=%d" % (workflow.admission.running()))
+    check(failures, workflow.admission.inflight == {'jobs': 0, 'cores': 0, 'ram': 0},
+          'slots left taken by a job raising in run(): %s' % (workflow.admission.inflight))
+
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+A local stub of a GA4GH TES endpoint: tasks are accepted on POST /v1/tasks
+and reported COMPLETE 'delay' seconds after submission.
+
+    python benchmarks/tes_stub.py [--port 8000] [--delay 1]
+
+serves until interrupted, e.g. for 'cwlrun --tes http://127.0.0.1:8000 ...'
+(the stub does not run anything: tools expecting outputs will fail to
+collect them). With '--jobs N' it instead submits N tasks to itself through
+TESService and the shared poller, and reports how long they took.
+
+    python benchmarks/tes_stub.py --cwl [--delay 0.2]
+
+runs a CWL tool (without outputs) through 'cwlrun --tes' against the stub,
+i.e. CommandLineJob.run(), the submit batcher and TESService, and checks
+the tasks it received: the script exits with status 1 if the run fails or
+a task is not a valid TES task.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from itertools import count
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cwlrun'))
+
+from command_line import TESService, TESMonitor
+from batcher import SubmitBatcher
+from poller import JobPoller
+import main as cwlrun
+
+# a tool exercising what create_task_msg() translates: input files, their
+# secondary files, literal files of the working directory, resources and
+# the container
+CHECK_TOOL = {
+    'cwlVersion': 'v1.0',
+    'class': 'CommandLineTool',
+    'baseCommand': ['wc', '-l'],
+    'requirements': [
+        {'class': 'DockerRequirement', 'dockerPull': 'busybox:1.27'},
+        {'class': 'ResourceRequirement', 'coresMin': 2, 'ramMin': 2048, 'outdirMin': 4096},
+        {'class': 'InitialWorkDirRequirement',
+         'listing': [{'entryname': 'settings.txt', 'entry': 'verbose=1'}]}
+    ],
+    'inputs': [{'id': 'reads', 'type': 'File', 'secondaryFiles': ['.idx'],
+                'inputBinding': {'position': 1}}],
+    'outputs': []
+}
+
+
+def check_task(task):
+    '''
+    Returns what is wrong in the body of a submitted task, checked against
+    the fields of the TES schema ([] if nothing is).
+    '''
+    errors = []
+    executors = task.get('executors') or []
+    if len(executors) != 1:
+        errors.append('expected 1 executor, got %d' % len(executors))
+    for e in executors:
+        if e.get('image') != 'busybox:1.27':
+            errors.append('executor image is %r' % e.get('image'))
+        if not e.get('command') or e['command'][:2] != ['wc', '-l']:
+            errors.append('executor command is %r' % e.get('command'))
+    for i in task.get('inputs') or []:
+        if not i.get('path') or not (i.get('url') or i.get('content')):
+            errors.append('input %s has no path, url or content' % i.get('name'))
+    names = sorted(i.get('name') for i in task.get('inputs') or [])
+    if names != ['reads', 'reads.txt.idx', 'settings.txt']:
+        errors.append('inputs are %s' % names)
+    resources = task.get('resources') or {}
+    if resources.get('cpu_cores') != 2 or not resources.get('ram_gb') or not resources.get('disk_gb'):
+        errors.append('resources are %s' % resources)
+    if not any(o.get('type') == 'DIRECTORY' for o in task.get('outputs') or []):
+        errors.append('the working directory is not an output')
+    return errors
+
+
+def run_cwl(addr):
+    work = tempfile.mkdtemp(prefix='tes-check-')
+    try:
+        tool = os.path.join(work, 'tool.cwl')
+        with open(tool, 'w') as handle:
+            json.dump(CHECK_TOOL, handle)
+        for name in ('reads.txt', 'reads.txt.idx'):
+            with open(os.path.join(work, name), 'w') as handle:
+                handle.write('a\nb\n')
+        job = os.path.join(work, 'job.json')
+        with open(job, 'w') as handle:
+            json.dump({'reads': {'class': 'File', 'location': os.path.join(work, 'reads.txt')}}, handle)
+
+        status = cwlrun.main(['--tes', addr, '--outdir', os.path.join(work, 'out'), tool, job])
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    failures = []
+    if status != 0:
+        failures.append('cwlrun exited with status %s' % status)
+    tasks = [task for started, task in TESHandler.tasks.values()]
+    if not tasks:
+        failures.append('no task was submitted')
+    for task in tasks:
+        failures.extend(check_task(task))
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    if not failures:
+        print("%d task(s) submitted through CommandLineJob and completed" % len(tasks))
+    return 1 if failures else 0
+
+
+class TESHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    ids = count()
+    tasks = {}
+    delay = 1.0
+
+    def reply(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        task = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+        task_id = "task-%d" % next(self.ids)
+        self.tasks[task_id] = (time.time(), task)
+        self.reply(200, {'id': task_id})
+
+    def do_GET(self):
+        task_id = self.path.split('?')[0].split('/')[-1]
+        if task_id not in self.tasks:
+            self.reply(404, {'message': 'task %s not found' % task_id})
+            return
+        started, task = self.tasks[task_id]
+        if time.time() - started < self.delay:
+            state = "RUNNING"
+        else:
+            state = "COMPLETE"
+        self.reply(200, {'id': task_id, 'state': state})
+
+    def log_message(self, *args):
+        pass
+
+
+class TESServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def run_jobs(addr, jobs):
+    service = TESService(addr)
+    poller = JobPoller()
+    batcher = SubmitBatcher(service)
+    done = threading.Semaphore(0)
+    states = []
+
+    def finished(task):
+        states.append(task['state'])
+        done.release()
+
+    def submitted(task_id):
+        monitor = TESMonitor(service, task_id, finished, jitter=0)
+        poller.add(monitor)
+
+    task = {'name': 'stub', 'executors': [{'image': 'busybox', 'command': ['true']}]}
+    started = time.time()
+    for i in range(jobs):
+        batcher.submit(task, callback=submitted)
+    for i in range(jobs):
+        done.acquire()
+    elapsed = time.time() - started
+    print("%d tasks in %.2fs, states: %s" % (
+        jobs, elapsed, dict((s, states.count(s)) for s in set(states))))
+    service.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--delay", type=float, default=1.0)
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--cwl", action="store_true")
+    args = parser.parse_args()
+
+    TESHandler.delay = args.delay
+    if args.jobs is None and not args.cwl:
+        server = TESServer(("127.0.0.1", args.port), TESHandler)
+        print("TES stub listening on http://127.0.0.1:%d" % server.server_address[1])
+        server.serve_forever()
+        return
+
+    server = TESServer(("127.0.0.1", 0), TESHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    addr = "http://127.0.0.1:%d" % server.server_address[1]
+    status = 0
+    if args.cwl:
+        status = run_cwl(addr)
+    else:
+        run_jobs(addr, args.jobs)
+    server.shutdown()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
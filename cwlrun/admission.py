@@ -0,0 +1,116 @@
+import time
+import threading
+import logging
+
+from timeouts import WAIT_TIMEOUT
+
+log = logging.getLogger('cloud_provision')
+
+class TokenBucket(object):
+    '''
+    Rate limiter: allows 'rate' operations per second on average, with bursts
+    of up to 'burst' operations.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def delay(self, peek=False):
+        '''
+        Returns 0 and consumes a token (unless 'peek') if one is available,
+        otherwise returns the number of seconds until the next token.
+        '''
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            if not peek:
+                self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController(object):
+    '''
+    Bounds the jobs in flight, so that a large scatter does not flood the
+    task service or the driver. A job is admitted only if, with it, there are
+    at most 'max_jobs' jobs in flight, and their ResourceRequirement adds up
+    to at most 'max_cores' cores and 'max_ram' MB of RAM; optionally, jobs are
+    also admitted at no more than 'rate' per second (bursts of 'burst').
+    Every limit is disabled when None.
+
+    A job asking for more than a resource limit is admitted alone, so that it
+    does not block the workflow forever.
+    '''
+    def __init__(self, max_jobs=None, max_cores=None, max_ram=None, rate=None, burst=None):
+        self.limits = {'jobs': max_jobs, 'cores': max_cores, 'ram': max_ram}
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.inflight = {'jobs': 0, 'cores': 0, 'ram': 0}
+        self.cond = threading.Condition()
+
+    def fits(self, cost):
+        if self.inflight['jobs'] == 0:
+            return True
+        for name, limit in self.limits.items():
+            if limit is not None and self.inflight[name] + cost[name] > limit:
+                return False
+        return True
+
+    def acquire(self, resources=None):
+        '''
+        Blocks until a job with the given 'resources' (as evaluated by cwltool:
+        a dict with 'cores' and 'ram') can be admitted, and returns the release
+        function for it, to be called once when the job is over.
+        '''
+        with self.cond:
+            while True:
+                release = self.try_acquire(resources)
+                if release is not None:
+                    return release
+                self.cond.wait(self.delay())
+
+    def try_acquire(self, resources=None):
+        '''
+        Admits a job with the given 'resources' if it can run now, and returns
+        its release function; returns None otherwise.
+        '''
+        resources = resources or {}
+        cost = {
+            'jobs': 1,
+            'cores': resources.get('cores') or 1,
+            'ram': resources.get('ram') or 0
+        }
+        with self.cond:
+            if not self.fits(cost):
+                return None
+            if self.bucket is not None and self.bucket.delay() > 0:
+                return None
+            for name in cost:
+                self.inflight[name] += cost[name]
+
+        released = []
+
+        def release():
+            with self.cond:
+                if released:
+                    return
+                released.append(True)
+                for name in cost:
+                    self.inflight[name] -= cost[name]
+                self.cond.notify_all()
+
+        return release
+
+    def delay(self):
+        '''
+        Returns how long to wait before trying to admit a job again.
+        '''
+        with self.cond:
+            if self.bucket is None:
+                return WAIT_TIMEOUT
+            return min(WAIT_TIMEOUT, max(self.bucket.delay(peek=True), 0.001))
+
+    def running(self):
+        with self.cond:
+            return self.inflight['jobs']
@@ -0,0 +1,134 @@
+import time
+import threading
+import logging
+from Queue import Queue
+
+import metrics
+from timeouts import WAIT_TIMEOUT
+
+log = logging.getLogger('cloud_provision')
+
+SUBMIT_LATENCY = metrics.Histogram(
+    'cwlrun_submit_latency_seconds', 'Time taken by the task service to accept a submission')
+SUBMIT_ERRORS = metrics.Counter('cwlrun_submit_errors', 'Failed task submissions')
+
+class SubmitBatcher(object):
+    '''
+    Buffers the tasks to be submitted to a task service for up to 'window'
+    seconds (or until 'max_batch' tasks are buffered) and submits them
+    together: with a single call to service.submit_batch(tasks) if the service
+    has a bulk endpoint, otherwise with concurrent service.submit(task) calls
+    from a pool of 'workers' threads.
+
+    Every task comes with a callback, called with the id assigned to the task,
+    and an optional errback, called with the exception if submission fails.
+    Threads are only started when the first task is submitted.
+    '''
+    def __init__(self, service, window=0.05, max_batch=500, workers=8):
+        self.service = service
+        self.window = window
+        self.max_batch = max_batch
+        self.workers = workers
+        self.buffer = []
+        self.inflight = 0
+        self.cond = threading.Condition()
+        self.queue = Queue()
+        self.threads = []
+
+    def submit(self, task, callback, errback=None):
+        with self.cond:
+            self.buffer.append((task, callback, errback))
+            self.inflight += 1
+            if not self.threads:
+                self.start()
+            self.cond.notify_all()
+
+    def flush(self):
+        '''
+        Blocks until every task submitted so far has been handed to the
+        service and its callback has run.
+        '''
+        with self.cond:
+            while self.inflight > 0:
+                self.cond.wait(WAIT_TIMEOUT)
+
+    def start(self):
+        self.threads.append(threading.Thread(target=self.collect))
+        for i in range(self.workers):
+            self.threads.append(threading.Thread(target=self.work))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def collect(self):
+        while True:
+            with self.cond:
+                while not self.buffer:
+                    self.cond.wait()
+                deadline = time.time() + self.window
+                while len(self.buffer) < self.max_batch and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                batch = self.buffer[:self.max_batch]
+                self.buffer = self.buffer[self.max_batch:]
+            self.send(batch)
+
+    def send(self, batch):
+        log.debug('Submitting a batch of %d tasks', len(batch))
+        submit_batch = getattr(self.service, 'submit_batch', None)
+        if submit_batch is None:
+            for item in batch:
+                self.queue.put(item)
+            self.queue.join()
+            return
+
+        started = time.time()
+        try:
+            task_ids = submit_batch([task for (task, callback, errback) in batch])
+        except Exception as e:
+            SUBMIT_ERRORS.inc(len(batch))
+            for (task, callback, errback) in batch:
+                self.done(errback, e)
+        else:
+            SUBMIT_LATENCY.observe(time.time() - started)
+            task_ids = list(task_ids or [])
+            if len(task_ids) != len(batch):
+                log.error('Bulk submission returned %d ids for %d tasks' % (len(task_ids), len(batch)))
+            for i, (task, callback, errback) in enumerate(batch):
+                if i < len(task_ids) and task_ids[i] is not None:
+                    self.done(callback, task_ids[i])
+                else:
+                    SUBMIT_ERRORS.inc()
+                    self.done(errback, Exception('No task id returned for task %d of the batch' % (i)))
+
+    def send_one(self, item):
+        task, callback, errback = item
+        started = time.time()
+        try:
+            task_id = self.service.submit(task)
+        except Exception as e:
+            SUBMIT_ERRORS.inc()
+            self.done(errback, e)
+        else:
+            SUBMIT_LATENCY.observe(time.time() - started)
+            self.done(callback, task_id)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.send_one(item)
+            finally:
+                self.queue.task_done()
+
+    def done(self, callback, arg):
+        try:
+            if callback is not None:
+                callback(arg)
+            elif isinstance(arg, Exception):
+                log.error('Task submission failed: %s' % (arg))
+        except Exception:
+            log.exception('Error in task submission callback')
+        finally:
+            with self.cond:
+                self.inflight -= 1
+                self.cond.notify_all()
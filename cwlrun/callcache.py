@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from Queue import Queue
+from collections import OrderedDict
+
+from staging import Stager, makedirs
+
+log = logging.getLogger('cloud_provision')
+
+CALL_CACHE_DIR = '.callcache'
+CALL_CACHE_META = 'outputs.json'
+
+class CallCache(object):
+    '''
+    A cache of completed steps in a directory of the shared store. Each entry,
+    <key>/, holds the outputs reported by the step (outputs.json) and a copy
+    of its output files (files/), so that later runs can skip a step whose
+    tool, container, command line, inputs and resources did not change.
+
+    Output files are copied with reflinks when the filesystem supports them
+    and with plain copies otherwise, but never hardlinked: the output
+    directory is rewritten by following tasks. Plain copies take as long as
+    the outputs are large, so jobs store their outputs with put_async(), on
+    a writer thread of the cache, rather than on the threads polling jobs.
+
+    Entries are evicted least recently used first, when there are more than
+    'max_entries' of them or their files take more than 'max_bytes' bytes.
+    '''
+    def __init__(self, root, stager=None, max_entries=None, max_bytes=None):
+        self.root = root
+        self.stager = stager if stager is not None else Stager(['reflink', 'copy'])
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.writer = None
+        makedirs(root)
+
+        found = []
+        for key in os.listdir(root):
+            meta = os.path.join(root, key, CALL_CACHE_META)
+            try:
+                with open(meta) as handle:
+                    size = json.load(handle).get('size', 0)
+                found.append((os.stat(meta).st_mtime, key, size))
+            except (IOError, OSError, ValueError):
+                continue
+        for used, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+
+    def key(self, tool, container, command_line, inputs, resources):
+        doc = json.dumps({
+            'tool': tool,
+            'container': container,
+            'command_line': command_line,
+            'inputs': inputs,
+            'resources': resources
+        }, sort_keys=True, default=str)
+        return hashlib.sha1(doc).hexdigest()
+
+    def get(self, key, outdir):
+        '''
+        Restores the output files of entry 'key' in 'outdir' and returns the
+        outputs recorded for it, or None if there is no (valid) such entry.
+        '''
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries[key] = self.entries.pop(key)
+
+        path = os.path.join(self.root, key)
+        meta = os.path.join(path, CALL_CACHE_META)
+        try:
+            with open(meta) as handle:
+                entry = json.load(handle)
+            for name in entry['files']:
+                self.stager.stage(os.path.join(path, 'files', name), os.path.join(outdir, name))
+            os.utime(meta, None)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.warning('Dropping call cache entry %s: %s' % (key, e))
+            self.evict(key)
+            return None
+        return entry['outputs']
+
+    def put(self, key, outputs, files):
+        '''
+        Records 'outputs' for 'key', together with a copy of 'files' (absolute
+        paths, restored by get() under their basename).
+        '''
+        path = os.path.join(self.root, key)
+        tmp = "%s.part-%d-%d" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            makedirs(os.path.join(tmp, 'files'))
+            size = 0
+            names = []
+            for src in files:
+                name = os.path.basename(src)
+                self.stager.stage(src, os.path.join(tmp, 'files', name))
+                size += os.path.getsize(src)
+                names.append(name)
+            with open(os.path.join(tmp, CALL_CACHE_META), 'w') as handle:
+                json.dump({'outputs': outputs, 'files': names, 'size': size,
+                           'created': time.time()}, handle)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            log.warning('Unable to cache the outputs of %s: %s' % (key, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            evicted = []
+            while len(self.entries) > 1 and (
+                    (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                    (self.max_bytes is not None and self.size > self.max_bytes)):
+                old, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old)
+        for old in evicted:
+            log.debug('Evicting call cache entry %s' % (old))
+            shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+
+    def put_async(self, key, outputs, files, callback):
+        '''
+        Queues put(key, outputs, files) to the writer thread of the cache, and
+        calls callback() there once it is done (whether the outputs could be
+        cached or not).
+        '''
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write, name='callcache')
+                self.writer.daemon = True
+                self.writer.start()
+        self.queue.put((key, outputs, files, callback))
+
+    def write(self):
+        while True:
+            key, outputs, files, callback = self.queue.get()
+            try:
+                self.put(key, outputs, files)
+            except Exception:
+                log.exception('Unable to cache the outputs of %s' % (key))
+            try:
+                callback()
+            except Exception:
+                log.exception('Call cache callback for %s failed' % (key))
+
+    def evict(self, key):
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
@@ -1,10 +1,15 @@
 import os
-import threading
+import json
 import logging
 import tes
+import tracing
 
-from workflow import WorkFlow
-from monitor import MonitorThread
+from workflow import WorkFlow, WorkflowJob
+from monitor import Monitor
+from batcher import SubmitBatcher
+from session import pooled_session
+from staging import write_contents
+from history import file_bytes
 
 import cwltool.draft2tool
 import cwltool.job
@@ -15,21 +20,81 @@ from cwltool.workflow import defaultMakeTool
 from schema_salad.ref_resolver import file_uri
 
 log = logging.getLogger('cloud_provision')
+# TES task states in which the task may still make progress
+TES_ACTIVE_STATES = ("UNKNOWN", "QUEUED", "INITIALIZING", "RUNNING", "PAUSED")
+
+def mib2gb(size):
+    return size / 953.674 if size is not None else None
+
+class TESService(object):
+    """
+    Client for a GA4GH TES endpoint. All the requests go through a single
+    keep-alive session (see pooled_session()), shared by the submitting and
+    polling threads. 'timeout' is in seconds.
+    """
+    def __init__(self, addr, pool_size=16, timeout=30, retries=3):
+        self.addr = addr.rstrip("/")
+        self.timeout = timeout
+        self.session = pooled_session(pool_size, retries)
+
+    @tracing.traced('submit')
+    def submit(self, task):
+        if hasattr(task, "as_json"):
+            body = task.as_json()
+        else:
+            body = json.dumps(task)
+        r = self.session.post(
+            "%s/v1/tasks" % (self.addr), data=body,
+            headers={"Content-Type": "application/json"}, timeout=self.timeout
+        )
+        r.raise_for_status()
+        return r.json()['id']
 
-class CommandLineJob(cwltool.job.CommandLineJob):
-    def __init__(self):
-        super(CommandLineJob, self).__init__()
+    def get_task(self, task_id, view="MINIMAL"):
+        r = self.session.get(
+            "%s/v1/tasks/%s" % (self.addr, task_id),
+            params={"view": view}, timeout=self.timeout
+        )
+        r.raise_for_status()
+        return r.json()
+
+class TESMonitor(Monitor):
+    def __init__(self, service, task_id, callback, **kwargs):
+        super(TESMonitor, self).__init__({'id': task_id}, **kwargs)
+        self.id = task_id
+        self.service = service
+        self.callback = callback
+
+    def poll(self):
+        return self.service.get_task(self.id)
+
+    def is_done(self, operation):
+        return operation.get('state', "UNKNOWN") not in TES_ACTIVE_STATES
+
+    def complete(self, operation):
+        self.callback(operation)
+
+    def state(self, operation):
+        return operation.get('state')
+
+class CommandLineJob(WorkflowJob, cwltool.job.CommandLineJob):
+    """
+    A cwltool job that, instead of running on the driver, is submitted as a
+    TES task (built by create_task_msg()) to the endpoint of the workflow and
+    tracked by its shared poller. Inputs and outputs are exchanged through
+    file:// URLs, so the TES workers must share the filesystem of the driver.
+    """
+    def __init__(self, workflow, spec):
+        cwltool.job.CommandLineJob.__init__(self)
+        WorkflowJob.__init__(self, spec, workflow)
 
-    # TODO: inspired by 'py-tes', these functions will construct a CWL task,
-    # to be executed on desired instances. these functions are not used
-    # at the moment, but will be useful one we establish a Mesos cluster
     def create_input_parameter(self, key, value):
         if "contents" in value:
             return tes.Input(
                 name=key,
                 description="cwl_input:%s" % (key),
                 path=value["path"],
-                contents=value["contents"],
+                content=value["contents"],
                 type=value["class"].upper()
             )
         else:
@@ -72,8 +137,7 @@ class CommandLineJob(cwltool.job.CommandLineJob):
         for item in listing:
             if "contents" in item:
                 loc = self.fs_access.join(self.tmpdir, item["basename"])
-                with self.fs_access.open(loc, "wb") as gen:
-                    gen.write(item["contents"])
+                write_contents(self.fs_access.realpath(loc), item["contents"])
             else:
                 loc = item["location"]
 
@@ -136,17 +200,12 @@ class CommandLineJob(cwltool.job.CommandLineJob):
 
         container = self.find_docker_requirement()
 
-        cpus = None
-        ram = None
-        disk = None
+        # cwltool evaluates the ResourceRequirement of the job into
+        # builder.resources, in mebibytes: TES wants gigabytes
+        resources = self.builder.resources or {}
         preempt = False
         for i in self.requirements:
             if i.get("class", "NA") == "ResourceRequirement":
-                cpus = i.get("coresMin", i.get("coresMax", None))
-                ram = i.get("ramMin", i.get("ramMax", None))
-                ram = ram / 953.674 if ram is not None else None
-                disk = i.get("outdirMin", i.get("outdirMax", None))
-                disk = disk / 953.674 if disk is not None else None
                 preempt = True if i.get("preemptible") else False
             elif i.get("class", "NA") == "DockerRequirement":
                 if i.get("dockerOutputDirectory", None) is not None:
@@ -164,21 +223,21 @@ class CommandLineJob(cwltool.job.CommandLineJob):
             description=self.spec.get("doc", ""),
             executors=[
                 tes.Executor(
-                    cmd=self.command_line,
-                    image_name=container,
+                    command=self.command_line,
+                    image=container,
                     workdir=self.docker_workdir,
                     stdout=self.output2path(self.stdout),
                     stderr=self.output2path(self.stderr),
                     stdin=self.stdin,
-                    environ=self.environment
+                    env=self.environment
                 )
             ],
             inputs=input_parameters,
             outputs=output_parameters,
             resources=tes.Resources(
-                cpu_cores=cpus,
-                ram_gb=ram,
-                size_gb=disk,
+                cpu_cores=int(resources["cores"]) if "cores" in resources else None,
+                ram_gb=mib2gb(resources.get("ram")),
+                disk_gb=mib2gb(resources.get("outdirSize")),
                 preemptible=preempt
             ),
             tags={"CWLDocumentId": self.spec.get("id")}
@@ -186,17 +245,66 @@ class CommandLineJob(cwltool.job.CommandLineJob):
 
         return create_body
 
-    # TODO: this is not currently called by the application, because it uses
-    # cwltool.CommandLineJob executor. We will need this one we create our own
-    # executor engine via Mesos
-    def run(self):
-        this = self
-
-        def launch(this, kwargs):
-            super(CommandLineJob, this).run(**kwargs)
+    def run(self, **kwargs):
+        self.fs_access = self.builder.fs_access
+        self.docker_workdir = self.builder.outdir
+        for d in (self.outdir, self.tmpdir):
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+        task_id = self.workflow.previous_task(self)
+        if task_id is not None:
+            log.info("Re-attaching %s to TES task %s" % (self.name, task_id))
+            self.submitted(task_id)
+            return
+
+        task = self.create_task_msg()
+        self.workflow.batcher.submit(
+            task, callback=self.submitted, errback=self.submitFailed
+        )
 
-        thread = threading.Thread(target=launch, args=(this, self.kwargs))
-        thread.start()
+    def submitted(self, task_id):
+        log.debug("TES task %s submitted for %s", task_id, self.name)
+        self.workflow.job_submitted(self, task_id)
+        tool_id = self.spec.get("id")
+        monitor = TESMonitor(
+            service=self.workflow.service,
+            task_id=task_id,
+            callback=self.jobCleanup,
+            errback=self.pollFailed,
+            tool_id=tool_id,
+            runtime_hint=self.workflow.runtime_hint(tool_id, file_bytes(self.joborder)),
+            **self.workflow.poll_options
+        )
+        self.workflow.add_monitor(monitor)
+
+    def submitFailed(self, error):
+        log.error("Submission of %s failed: %s" % (self.name, error))
+        self.jobFailed()
+
+    def pollFailed(self, error):
+        log.error("Lost track of TES task of %s: %s" % (self.name, error))
+        self.jobFailed()
+
+    def jobFailed(self):
+        self.output_callback({}, "permanentFail")
+        self.workflow.notify_progress()
+
+    @tracing.traced('collect_outputs')
+    def jobCleanup(self, task):
+        outputs = {}
+        if task.get('state') == "COMPLETE":
+            try:
+                outputs = self.collect_outputs(self.outdir)
+                status = "success"
+            except Exception:
+                log.exception("Unable to collect outputs of %s" % (self.name))
+                status = "permanentFail"
+        else:
+            log.error("TES task %s of %s ended in state %s" % (
+                task.get('id'), self.name, task.get('state')))
+            status = "permanentFail"
+        self.output_callback(outputs, status)
 
     def output2url(self, path):
         if path is not None:
@@ -211,13 +319,40 @@ class CommandLineJob(cwltool.job.CommandLineJob):
         return None
 
 class CommandLineTool(cwltool.draft2tool.CommandLineTool):
-    def __init__(self, spec, **kwargs):
+    def __init__(self, spec, wf=None, **kwargs):
         super(CommandLineTool, self).__init__(spec, **kwargs)
+        self.workflow = wf
+
+    def makeJobRunner(self, use_container=True, **kwargs):
+        # without a TES endpoint jobs run on the driver, through cwltool
+        if self.workflow is None or self.workflow.service is None:
+            job = super(CommandLineTool, self).makeJobRunner(use_container, **kwargs)
+            # lets the workflow tell which tool the job belongs to
+            job.spec = self.tool
+            return job
+        return CommandLineJob(self.workflow, self.tool)
 
 
 class CommandLineWorkflow(WorkFlow):
     def __init__(self, kwargs):
-        super(CommandLineWorkflow, self).__init__()
+        super(CommandLineWorkflow, self).__init__(kwargs)
+
+        if kwargs.get("tes"):
+            self.service = TESService(
+                kwargs["tes"],
+                pool_size=int(kwargs.get('http_pool_size', 16)),
+                timeout=float(kwargs.get('http_timeout', 30)),
+                retries=int(kwargs.get('http_retries', 3))
+            )
+            self.batcher = SubmitBatcher(
+                self.service,
+                window=float(kwargs.get('submit_window', 0.05)),
+                max_batch=int(kwargs.get('submit_batch', 500)),
+                workers=int(kwargs.get('submit_workers', 8))
+            )
+        else:
+            self.service = None
+            self.batcher = None
 
         if kwargs.get("basedir") is not None:
             self.basedir = kwargs.get("basedir")
@@ -225,8 +360,13 @@ class CommandLineWorkflow(WorkFlow):
             self.basedir = os.getcwd()
         self.fs_access = StdFsAccess(self.basedir)
 
+    def wait(self):
+        if self.batcher is not None:
+            self.batcher.flush()
+        super(CommandLineWorkflow, self).wait()
+
     def make_exec_tool(self, spec, **kwargs):
-        return CommandLineTool(spec, **kwargs)
+        return CommandLineTool(spec, self, **kwargs)
 
     def make_tool(self, spec, **kwargs):
         if 'class' in spec and spec['class'] == 'CommandLineTool':
@@ -0,0 +1,82 @@
+import logging
+import threading
+import multiprocessing
+
+from io_utilities import file_checksum
+
+log = logging.getLogger('cloud_provision')
+
+def _checksum(path):
+    # exceptions are returned rather than raised: Pool.apply_async() in
+    # python 2 has no error callback
+    try:
+        return file_checksum(path), None
+    except Exception as e:
+        return None, str(e)
+
+class DigestPool(object):
+    '''
+    A bounded pool of 'processes' worker processes computing output
+    checksums, so that digesting many large outputs scales with cores and
+    disks instead of running serially on the threads that poll the jobs.
+
+    The pool forks its workers when created, which is only safe before the
+    driver starts any thread (a forked child inherits the locks other
+    threads hold): creating it later raises an error. It must be close()d
+    once the run is over, so that the workers do not outlive it.
+    '''
+    def __init__(self, processes=None):
+        others = [t.name for t in threading.enumerate() if t is not threading.current_thread()]
+        if others:
+            raise RuntimeError('DigestPool created after threads were started: %s' % (', '.join(others)))
+        self.pool = multiprocessing.Pool(processes)
+
+    def checksums(self, paths, callback):
+        '''
+        Computes the checksum of every path in 'paths' (a dict of key -> path)
+        and calls 'callback' once with a dict of key -> checksum. Files that
+        could not be digested are left out of the result.
+
+        The callback runs on the result handler thread of the pool, which
+        dies on an exception (and with it the delivery of every following
+        result): what the callback raises is logged and dropped.
+        '''
+        results = {}
+        remaining = [len(paths)]
+        lock = threading.Lock()
+
+        if not paths:
+            callback(results)
+            return
+
+        def done(key, path, result):
+            checksum, error = result
+            with lock:
+                if error is not None:
+                    log.warning('Unable to compute checksum of %s: %s' % (path, error))
+                else:
+                    results[key] = checksum
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                try:
+                    callback(results)
+                except Exception:
+                    log.exception('Checksum callback failed')
+
+        for key, path in paths.items():
+            self.pool.apply_async(
+                _checksum, (path,),
+                callback=lambda result, key=key, path=path: done(key, path, result)
+            )
+
+    def close(self, terminate=False):
+        '''
+        Waits for the pending checksums and stops the workers or, with
+        'terminate', stops them right away.
+        '''
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import math
+import logging
+import threading
+
+log = logging.getLogger('cloud_provision')
+
+# records kept per (tool, input size bucket)
+HISTORY_DEPTH = 50
+
+def size_bucket(input_bytes):
+    '''
+    Buckets input sizes by powers of 4: 0 for no input (or less than 4
+    bytes), then 1 for [4, 16) bytes and so on.
+    '''
+    if not input_bytes or input_bytes < 4:
+        return 0
+    return int(math.log(input_bytes, 4))
+
+def file_bytes(value):
+    '''
+    Returns the total size of the Files in a CWL job order or output object.
+    '''
+    if isinstance(value, dict):
+        if value.get('class') == 'File':
+            return (value.get('size') or 0) + file_bytes(value.get('secondaryFiles'))
+        return sum(file_bytes(v) for v in value.values())
+    if isinstance(value, list):
+        return sum(file_bytes(v) for v in value)
+    return 0
+
+class RuntimeHistory(object):
+    '''
+    Records how the jobs of each tool ran: wall time and, when known, CPU
+    time, peak RSS (in MB) and I/O bytes, by tool id and input size bucket.
+    Only the last HISTORY_DEPTH records of each bucket are kept.
+
+    With a 'path' (given here or to open()), records are appended to it,
+    one JSON record per line, and loaded back at start-up, so that
+    predictions carry over between runs; the file is compacted when it holds
+    more stale records than live ones. Without one, the history lasts for
+    the run only.
+    '''
+    def __init__(self, path=None):
+        self.path = None
+        self.records = {}
+        self.lock = threading.Lock()
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        '''
+        Keeps the history in 'path' from now on: loads the records it holds,
+        and appends the new ones to it.
+        '''
+        lines = 0
+        with self.lock:
+            if os.path.exists(path):
+                with open(path) as handle:
+                    for line in handle:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        self.add(record)
+                        lines += 1
+            self.path = path
+            stale = lines > 2 * sum(len(r) for r in self.records.values())
+        if stale:
+            self.compact()
+
+    def add(self, record):
+        key = (record['tool'], record['bucket'])
+        records = self.records.setdefault(key, [])
+        records.append(record)
+        del records[:-HISTORY_DEPTH]
+
+    def record(self, tool_id, input_bytes, wall, cpu=None, rss=None, io=None):
+        record = {
+            'tool': tool_id,
+            'bucket': size_bucket(input_bytes),
+            'input': input_bytes,
+            'wall': wall,
+            'cpu': cpu,
+            'rss': rss,
+            'io': io,
+            'time': time.time()
+        }
+        with self.lock:
+            self.add(record)
+            if self.path is not None:
+                try:
+                    with open(self.path, 'a') as handle:
+                        handle.write(json.dumps(record) + "\n")
+                except (IOError, OSError) as e:
+                    log.warning('Unable to record runtime history in %s: %s' % (self.path, e))
+
+    def compact(self):
+        with self.lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as handle:
+                for records in self.records.values():
+                    for record in records:
+                        handle.write(json.dumps(record) + "\n")
+            os.rename(tmp, self.path)
+
+    def lookup(self, tool_id, input_bytes=None):
+        '''
+        Returns the records of the bucket of 'input_bytes' or, if there are
+        none (or 'input_bytes' is None), those of the nearest bucket with
+        records for the tool.
+        '''
+        with self.lock:
+            buckets = [b for (t, b) in self.records if t == tool_id]
+            if not buckets:
+                return []
+            if input_bytes is None:
+                return [r for b in buckets for r in self.records[(tool_id, b)]]
+            bucket = size_bucket(input_bytes)
+            nearest = min(buckets, key=lambda b: (abs(b - bucket), -b))
+            return list(self.records[(tool_id, nearest)])
+
+    def query(self, tool_id, input_bytes=None):
+        '''
+        Returns statistics of the past jobs of a tool, for the given input
+        size (see lookup()): the number of records, mean and maximum wall
+        time, mean CPU time, maximum peak RSS and mean I/O bytes, or None if
+        nothing was ever recorded for it. Unknown metrics are None.
+        '''
+        records = self.lookup(tool_id, input_bytes)
+        if not records:
+            return None
+
+        def values(name):
+            return [r[name] for r in records if r.get(name) is not None]
+
+        def mean(name):
+            v = values(name)
+            return sum(v) / float(len(v)) if v else None
+
+        return {
+            'count': len(records),
+            'wall': mean('wall'),
+            'wall_max': max(values('wall')),
+            'cpu': mean('cpu'),
+            'rss_max': max(values('rss')) if values('rss') else None,
+            'io': mean('io')
+        }
+
+    def runtime(self, tool_id, input_bytes=None):
+        '''
+        Returns the expected wall time of a job of the tool (in seconds), or
+        None if unknown.
+        '''
+        stats = self.query(tool_id, input_bytes)
+        return stats['wall'] if stats is not None else None
+
+    def resources(self, tool_id, input_bytes=None, margin=1.2):
+        '''
+        Predicts the resources a job of the tool needs, in the terms of
+        cwltool evaluated ResourceRequirement ('cores', 'ram' in MB): the cores
+        kept busy on average and the peak RSS plus a 'margin'. Returns an
+        empty dict when nothing is known.
+        '''
+        stats = self.query(tool_id, input_bytes)
+        predicted = {}
+        if stats is None:
+            return predicted
+        if stats['cpu'] is not None and stats['wall']:
+            predicted['cores'] = max(1, int(math.ceil(stats['cpu'] / stats['wall'])))
+        if stats['rss_max'] is not None:
+            predicted['ram'] = int(math.ceil(stats['rss_max'] * margin))
+        return predicted
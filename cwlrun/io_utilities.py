@@ -1,20 +1,160 @@
 import os
+import copy
+import stat
+import errno
 import glob
+import hashlib
+import threading
 import fnmatch
-import logging
 from io import BytesIO
-from pprint import pformat
 
 import cwltool.stdfsaccess
 from cwltool.stdfsaccess import StdFsAccess
 
-log = logging.getLogger('cloud_provision')
+import logs
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+log = logs.get_logger()
+
+CHECKSUM_BUFSIZE = 1024 * 1024
+
+def file_checksum(path):  # type: (unicode) -> unicode
+    """
+    Returns the SHA-1 of a file in CWL format ('sha1$...'), reading it in
+    fixed-size blocks so that memory use does not depend on file size.
+    """
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(CHECKSUM_BUFSIZE), b''):
+            checksum.update(block)
+    return "sha1$%s" % checksum.hexdigest()
+
+def scan(path):  # type: (unicode) -> Dict[unicode, bool]
+    """
+    Returns the entries of a directory as a dict of name -> is a directory,
+    using scandir (no stat per entry on most filesystems) when available.
+    Without it, whether an entry is a directory is left unknown (None)
+    rather than paid for with a stat per entry.
+    """
+    if scandir is not None:
+        return dict((entry.name, entry.is_dir()) for entry in scandir(path))
+    return dict.fromkeys(os.listdir(path))
+
+class ChecksumIndex(object):
+    """
+    A persistent index of file checksums, keyed by (device, inode, size,
+    mtime): a file that did not change since it was last digested is never
+    hashed again, across restarts too.
+
+    The index is an append-only log, one entry per line, loaded in memory at
+    start-up and compacted when it holds more stale entries than live ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        lines = 0
+        if os.path.exists(path):
+            with open(path) as handle:
+                for line in handle:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        self.entries[fields[0]] = fields[1]
+                        lines += 1
+        if lines > 2 * len(self.entries):
+            self.compact()
+
+    def key(self, st):
+        return "%d:%d:%d:%r" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def get(self, path):
+        st = os.stat(path)
+        with self.lock:
+            return self.entries.get(self.key(st))
+
+    def put(self, path, checksum):
+        key = self.key(os.stat(path))
+        with self.lock:
+            if self.entries.get(key) == checksum:
+                return
+            self.entries[key] = checksum
+            with open(self.path, 'a') as handle:
+                handle.write("%s %s\n" % (key, checksum))
+
+    def compact(self):
+        with self.lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as handle:
+                for key, checksum in self.entries.items():
+                    handle.write("%s %s\n" % (key, checksum))
+            os.rename(tmp, self.path)
 
 class IOutilities(StdFsAccess):
-    def __init__(self, base, storage):
-        log.debug('init path ==> ' + base)
+    """
+    File system access to the shared store. Instances returned by cached()
+    keep the directory listings and the stats they read: they are meant to be
+    used for the outputs of a single completed task, and dropped (or
+    invalidate()d) afterwards. Directories are only listed for the wildcards
+    of globs and for listdir; other paths cost a single stat, answered from
+    a listing already read when there is one, since the shared output
+    directory can hold many more files than a task produces.
+    """
+    def __init__(self, base, storage, index=None):
+        log.debug('init path ==> %s', base)
         self.base = base
         self.storage = storage
+        self.checksums = ChecksumIndex(index) if index is not None else None
+        self.listings = None
+        self.stats = None
+
+    def cached(self):
+        view = copy.copy(self)
+        view.listings = {}
+        view.stats = {}
+        return view
+
+    def invalidate(self):
+        if self.listings is not None:
+            self.listings.clear()
+            self.stats.clear()
+
+    def _listing(self, path):  # type: (unicode) -> Optional[Dict[unicode, bool]]
+        if self.listings is not None and path in self.listings:
+            return self.listings[path]
+        try:
+            listing = scan(path)
+        except OSError:
+            listing = None
+        if self.listings is not None:
+            self.listings[path] = listing
+        return listing
+
+    def _lookup(self, path):  # type: (unicode) -> Optional[bool]
+        """
+        Returns None if path does not exist, otherwise whether it is a
+        directory: from the listing of its parent if it was read, otherwise
+        from a (cached) stat of the path.
+        """
+        parent, name = os.path.split(path)
+        listing = self.listings.get(parent) if name else None
+        if listing is not None:
+            if name not in listing:
+                return None
+            if listing[name] is not None:
+                return listing[name]
+        if path not in self.stats:
+            try:
+                self.stats[path] = stat.S_ISDIR(os.stat(path).st_mode)
+            except OSError:
+                self.stats[path] = None
+        return self.stats[path]
 
     def _abs(self, p):  # type: (unicode) -> unicode
         return os.path.abspath(os.path.join(self.base, self.storage, p))
@@ -24,27 +164,78 @@ class IOutilities(StdFsAccess):
 
     def glob(self, pattern):  # type: (unicode) -> List[unicode]
         absolute = self._abs(pattern)
-        globs = glob.glob(absolute)
-        log.debug("ABSOLUTE: " + pformat(absolute))
-        log.debug("GLOBS: " + pformat(globs))
+        parts = absolute.split(os.sep)
+        globs = [os.sep]
+        for part in parts[1:]:
+            if not glob.has_magic(part):
+                globs = [os.path.join(p, part) for p in globs]
+                continue
+            matched = []
+            for path in globs:
+                listing = self._listing(path)
+                if not listing:
+                    continue
+                names = listing.keys()
+                # as glob.glob, wildcards do not match hidden files
+                if not part.startswith('.'):
+                    names = [n for n in names if not n.startswith('.')]
+                matched.extend(os.path.join(path, n) for n in sorted(fnmatch.filter(names, part)))
+            globs = matched
+        if not glob.has_magic(parts[-1]):
+            if self.listings is None:
+                globs = [p for p in globs if os.path.lexists(p)]
+            else:
+                globs = [p for p in globs if self._lookup(p) is not None]
 
-        return [self._abs(l) for l in globs]
-        # return ["fs://%s" % self._abs(l) for l in globs]
+        log.debug_event('glob', pattern=pattern, absolute=absolute, globs=globs)
+
+        return globs
 
     def open(self, fn, mode):  # type: (unicode, str) -> BinaryIO
         return open(self._abs(fn), mode)
 
+    def size(self, fn):  # type: (unicode) -> int
+        return os.stat(self._abs(fn)).st_size
+
+    def checksum(self, fn):  # type: (unicode) -> unicode
+        checksum = self.cached_checksum(fn)
+        if checksum is None:
+            checksum = file_checksum(self._abs(fn))
+            self.record_checksum(fn, checksum)
+        return checksum
+
+    def cached_checksum(self, fn):  # type: (unicode) -> Optional[unicode]
+        if self.checksums is None:
+            return None
+        return self.checksums.get(self._abs(fn))
+
+    def record_checksum(self, fn, checksum):  # type: (unicode, unicode) -> None
+        if self.checksums is not None:
+            self.checksums.put(self._abs(fn), checksum)
+
     def exists(self, fn):  # type: (unicode) -> bool
-        return os.path.exists(self._abs(fn))
+        if self.listings is None:
+            return os.path.exists(self._abs(fn))
+        return self._lookup(self._abs(fn)) is not None
 
     def isfile(self, fn):  # type: (unicode) -> bool
-        return os.path.isfile(self._abs(fn))
+        if self.listings is None:
+            return os.path.isfile(self._abs(fn))
+        return self._lookup(self._abs(fn)) is False
 
     def isdir(self, fn):  # type: (unicode) -> bool
-        return os.path.isdir(self._abs(fn))
+        if self.listings is None:
+            return os.path.isdir(self._abs(fn))
+        return self._lookup(self._abs(fn)) is True
 
     def listdir(self, fn):  # type: (unicode) -> List[unicode]
-        return [cwltool.stdfsaccess.abspath(l, fn) for l in os.listdir(self._abs(fn))]
+        if self.listings is None:
+            names = os.listdir(self._abs(fn))
+        else:
+            names = self._listing(self._abs(fn))
+            if names is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), self._abs(fn))
+        return [cwltool.stdfsaccess.abspath(l, fn) for l in names]
 
     def join(self, path, *paths):  # type: (unicode, *unicode) -> unicode
         return os.path.join(path, *paths)
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+log = logging.getLogger('cloud_provision')
+
+def strip_paths(value):
+    if isinstance(value, dict):
+        return dict((k, strip_paths(v)) for k, v in value.items() if k not in ('path', 'dirname'))
+    if isinstance(value, list):
+        return [strip_paths(v) for v in value]
+    return value
+
+class JobJournal(object):
+    '''
+    An append-only journal of the jobs of a workflow run, one JSON record per
+    line: the task id assigned to each submitted job, and the outputs of each
+    completed one. Jobs are identified by job_key().
+
+    With 'restart', the records of the previous run are loaded, so that its
+    finished jobs are not run again and its submitted ones are re-attached
+    to; otherwise the journal starts empty. A truncated last line (the driver
+    crashed while writing it) is ignored.
+    '''
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.tasks = {}
+        self.completed = {}
+        self.lock = threading.Lock()
+        complete = True
+        if restart and os.path.exists(path):
+            with open(path) as handle:
+                for line in handle:
+                    complete = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('event') == 'submit':
+                        self.tasks[record['key']] = record['task']
+                    elif record.get('event') == 'done':
+                        self.tasks.pop(record['key'], None)
+                        if record['status'] == 'success':
+                            self.completed[record['key']] = (record['outputs'], record['status'])
+            log.info('Journal %s: %d completed and %d running jobs' % (
+                path, len(self.completed), len(self.tasks)))
+        self.handle = open(path, 'a' if restart else 'w')
+        if not complete:
+            self.handle.write("\n")
+
+    def job_key(self, job):
+        '''
+        Identifies a job across runs by its name and job order. Staging paths
+        change at every run, so they are left out, and so is the command line
+        that embeds them.
+        '''
+        doc = json.dumps({
+            'name': getattr(job, 'name', None),
+            'joborder': strip_paths(getattr(job, 'joborder', None))
+        }, sort_keys=True, default=str)
+        return hashlib.sha1(doc).hexdigest()
+
+    def write(self, record):
+        with self.lock:
+            self.handle.write(json.dumps(record, default=str) + "\n")
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+
+    def submitted(self, key, task_id):
+        with self.lock:
+            self.tasks[key] = task_id
+        self.write({'event': 'submit', 'key': key, 'task': task_id})
+
+    def done(self, key, outputs, status):
+        with self.lock:
+            self.tasks.pop(key, None)
+            if status == 'success':
+                self.completed[key] = (outputs, status)
+        self.write({'event': 'done', 'key': key, 'outputs': outputs, 'status': status})
+
+    def task(self, key):
+        with self.lock:
+            return self.tasks.get(key)
+
+    def result(self, key):
+        '''
+        Returns the outputs of the job if it completed successfully, or None.
+        '''
+        with self.lock:
+            completed = self.completed.get(key)
+        return completed[0] if completed is not None else None
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
@@ -1,39 +1,46 @@
 import os
 import json
-import shutil
-import logging
-import hashlib
-from pprint import pformat
+import time
+import threading
+import multiprocessing
 
 import cwltool.draft2tool
+from cwltool.errors import WorkflowException
 from cwltool.pathmapper import MapperEnt
 
-from monitor import MonitorThread
+from monitor import Monitor
+from batcher import SubmitBatcher
+from staging import Stager, ContentStore, write_contents
+from digest import DigestPool
+from callcache import CallCache, CALL_CACHE_DIR
+from history import file_bytes
+import tracing
+import logs
 from workflow import WorkFlow, WorkflowJob
 from io_utilities import IOutilities
+from session import pooled_session
 
-try:
-    import requests
-except ImportError:
-    pass
-
-log = logging.getLogger('cloud_provision')
+log = logs.get_logger()
 BASE_MOUNT = "/mnt"
+CHECKSUM_INDEX = ".checksums"
+RUNTIME_HISTORY = ".history"
 
 class LocalStoragePathMapper(cwltool.pathmapper.PathMapper):
     """
     This class extends the 'PathMapper' object in cwltool.
     """
 
-    def __init__(self, referenced_files, basedir, store_base, **kwargs):
+    def __init__(self, referenced_files, basedir, store_base, store=None, **kwargs):
         self.store_base = store_base
+        self.store = store if store is not None else ContentStore(store_base)
         self.setup(referenced_files, basedir)
 
+    @tracing.traced('stage')
     def setup(self, referenced_files, basedir):
-        log.debug("PATHMAPPER: " + pformat(referenced_files))
+        log.debug('PATHMAPPER: %s', logs.Pretty(referenced_files))
         self._pathmap = {}
         for src in referenced_files:
-            log.debug('SOURCE: ' + str(src))
+            log.debug('SOURCE: %s', src)
             if src['location'].startswith("fs://"):
                 target_name = os.path.basename(src['location'])
                 self._pathmap[src['location']] = MapperEnt(
@@ -43,46 +50,105 @@ class LocalStoragePathMapper(cwltool.pathmapper.PathMapper):
                 )
             elif src['location'].startswith("file://"):
                 src_path = src['location'][7:]
-                log.debug("Copying %s to shared %s" % (src['location'], self.store_base))
-                dst = os.path.join(self.store_base, os.path.basename(src_path))
-                shutil.copy(src_path, dst)
-                location = "fs://%s" % (os.path.basename(src['location']))
+                log.debug_event('staging', source=src['location'], store=self.store_base)
+                name, strategy = self.store.stage(src_path)
+                log.debug_event('staged', source=src['location'], name=name, strategy=strategy)
                 self._pathmap[src['location']] = MapperEnt(
-                    resolved=location,
-                    target=os.path.join(BASE_MOUNT, os.path.basename(src['location'])),
+                    resolved="fs://%s" % (name),
+                    target=os.path.join(BASE_MOUNT, name),
                     type=src['class']
                 )
             else:
                 raise Exception("Unknown file source: %s" %(src['location']))
-        log.debug('PATHMAP: ' + pformat(self._pathmap))
+        log.debug('PATHMAP: %s', logs.Pretty(self._pathmap))
 
 class LocalService:
-    def __init__(self, addr):
+    """
+    Client for the task service. All the requests go through a single
+    keep-alive session (see pooled_session()), whose connection pool is shared
+    by every monitor: 'pool_size' should be at least the number of threads
+    issuing requests. 'timeout' is in seconds. Server metadata is cached for
+    'metadata_ttl' seconds.
+    """
+    def __init__(self, addr, pool_size=16, timeout=30, retries=3, metadata_ttl=300):
         self.addr = addr
-
+        self.timeout = timeout
+        self.metadata_ttl = metadata_ttl
+        self.metadata = None
+        self.metadata_time = 0
+        self.metadata_lock = threading.Lock()
+        self.session = pooled_session(pool_size, retries)
+
+    @tracing.traced('submit')
     def submit(self, task):
-        r = requests.post("%s/v1/jobs" % (self.addr), json=task)
+        r = self.session.post("%s/v1/jobs" % (self.addr), json=task, timeout=self.timeout)
         data = r.json()
         if 'Error' in data:
             raise Exception("Request Error: %s" % (data['Error']) )
         return data['value']
 
     def get_job(self, job_id):
-        r = requests.get("%s/v1/jobs/%s" % (self.addr, job_id))
+        r = self.session.get("%s/v1/jobs/%s" % (self.addr, job_id), timeout=self.timeout)
         return r.json()
 
-    def get_server_metadata(self):
-        r = requests.get("%s/v1/jobs-service" % (self.addr))
-        return r.json()
+    def get_server_metadata(self, refresh=False):
+        with self.metadata_lock:
+            if (refresh or self.metadata is None or
+                    time.time() - self.metadata_time > self.metadata_ttl):
+                r = self.session.get("%s/v1/jobs-service" % (self.addr), timeout=self.timeout)
+                self.metadata = r.json()
+                self.metadata_time = time.time()
+            return self.metadata
+
+    def invalidate_metadata(self):
+        with self.metadata_lock:
+            self.metadata = None
 
 class LocalWorkflow(WorkFlow):
     def __init__(self, config, args):
+        self.compute_checksums = str(config.get('checksums', True)).lower() not in ('0', 'false', 'no')
+        # the digest pool forks, so it is created before anything (including
+        # WorkFlow.__init__) can start a thread; DigestPool enforces it. With
+        # 0 workers checksums are computed on the polling threads.
+        workers = int(config.get('checksum_workers', multiprocessing.cpu_count()))
+        self.digests = DigestPool(workers) if self.compute_checksums and workers > 0 else None
         super(LocalWorkflow, self).__init__(config)
         self.args = args
-        self.service = LocalService(config['url'])
+        # cache what output collection reads of the store, per task (see
+        # IOutilities.cached())
+        self.listing_cache = str(config.get('listing_cache', False)).lower() in ('1', 'true', 'yes')
+        self.service = LocalService(
+            config['url'],
+            pool_size=int(config.get('http_pool_size', 16)),
+            timeout=float(config.get('http_timeout', 30)),
+            retries=int(config.get('http_retries', 3)),
+            metadata_ttl=float(config.get('metadata_ttl', 300))
+        )
+        strategies = config.get('stage_strategies')
+        self.stager = Stager(strategies.split(',') if strategies else None)
+        self.copier = Stager(['copy'])
+        self.stores = {}
+        self.batcher = SubmitBatcher(
+            self.service,
+            window=float(config.get('submit_window', 0.05)),
+            max_batch=int(config.get('submit_batch', 500)),
+            workers=int(config.get('submit_workers', 8))
+        )
         meta = self.service.get_server_metadata()
         if meta['storageConfig'].get("storageType", "") == "sharedFile":
-            self.local_path = IOutilities(meta['storageConfig']['baseDir'], "output")
+            base = meta['storageConfig']['baseDir']
+            index = config.get('checksum_index', os.path.join(base, CHECKSUM_INDEX))
+            self.local_path = IOutilities(base, "output", index=index or None)
+            if not config.get('history'):
+                self.history.open(os.path.join(base, RUNTIME_HISTORY))
+            if str(config.get('call_cache', False)).lower() in ('1', 'true', 'yes'):
+                size = config.get('call_cache_mb')
+                entries = config.get('call_cache_entries')
+                self.callcache = CallCache(
+                    os.path.join(base, CALL_CACHE_DIR),
+                    max_entries=int(entries) if entries else None,
+                    max_bytes=float(size) * 1024 * 1024 if size else None
+                )
         self.output_dir = os.path.join(self.local_path.protocol(), "outdir")
 
     def create_parameters(self, puts, pathmapper, create=False):
@@ -108,12 +174,13 @@ class LocalWorkflow(WorkFlow):
 
         return parameters
 
+    @tracing.traced('create_task')
     def create_task(self, container, command, inputs, outputs, volumes, config, pathmapper, stdout=None, stderr=None):
         input_parameters = self.create_parameters(inputs, pathmapper)
         output_parameters = self.create_parameters(outputs, pathmapper, create=True)
         workdir = os.path.join(BASE_MOUNT, "work")
 
-        log.debug("LOCAL_URI: " + self.local_path.protocol())
+        log.debug('LOCAL_URI: %s', self.local_path.protocol())
 
         output_parameters.append({
             'name': 'workdir',
@@ -167,6 +234,40 @@ class LocalWorkflow(WorkFlow):
 
         return create_body
 
+    def content_store(self, base):
+        if base not in self.stores:
+            self.stores[base] = ContentStore(
+                base, self.stager, mode=self.config.get('stage_key', 'stat'),
+                index=self.local_path.checksums)
+        return self.stores[base]
+
+    def output_exists(self, location):
+        if location.startswith(self.local_path.protocol()):
+            return self.local_path.exists(location[len(self.local_path.protocol()):])
+        if "://" not in location:
+            return self.local_path.exists(location)
+        return super(LocalWorkflow, self).output_exists(location)
+
+    def executor(self, tool, job_order, **kwargs):
+        try:
+            return super(LocalWorkflow, self).executor(tool, job_order, **kwargs)
+        finally:
+            # on errors wait() is not reached: jobs may still be running
+            self.close_digests(terminate=True)
+
+    def wait(self):
+        try:
+            # tasks still buffered for submission have no monitor yet
+            self.batcher.flush()
+            super(LocalWorkflow, self).wait()
+        finally:
+            self.close_digests()
+
+    def close_digests(self, terminate=False):
+        if self.digests is not None:
+            digests, self.digests = self.digests, None
+            digests.close(terminate=terminate)
+
     def make_exec_tool(self, spec, **kwargs):
         return LocalWorkflowTool(spec, self, fs_access=self.local_path, **kwargs)
 
@@ -183,20 +284,23 @@ class LocalWorkflowTool(cwltool.draft2tool.CommandLineTool):
     def makePathMapper(self, reffiles, stagedir, **kwargs):
         m = self.workflow.service.get_server_metadata()
         if m['storageConfig'].get('storageType', "") == "sharedFile":
-            return LocalStoragePathMapper(reffiles, store_base=m['storageConfig']['baseDir'], **kwargs)
+            base = m['storageConfig']['baseDir']
+            return LocalStoragePathMapper(reffiles, store_base=base,
+                                          store=self.workflow.content_store(base), **kwargs)
 
 class LocalWorkflowJob(WorkflowJob):
     def __init__(self, spec, workflow, local_path):
         super(LocalWorkflowJob,self).__init__(spec, workflow)
         self.running = False
         self.local_path = local_path
+        self.call = None
 
     def run(self, dry_run=False, pull_image=True, **kwargs):
         id = self.spec['id']
 
-        log.debug('SPEC: ' + pformat(self.spec))
-        log.debug('JOBORDER: ' + pformat(self.joborder))
-        log.debug('GENERATEFILES: ' + pformat(self.generatefiles))
+        log.debug('SPEC: %s', logs.Pretty(self.spec))
+        log.debug('JOBORDER: %s', logs.Pretty(self.joborder))
+        log.debug('GENERATEFILES: %s', logs.Pretty(self.generatefiles))
 
         #prepare the inputs
         inputs = {}
@@ -206,15 +310,27 @@ class LocalWorkflowJob(WorkflowJob):
 
         for listing in self.generatefiles['listing']:
             if listing['class'] == 'File':
-                with self.local_path.open(listing['basename'], 'wb') as gen:
-                    gen.write(listing['contents'])
+                target = self.local_path._abs(listing['basename'])
+                if 'contents' in listing:
+                    write_contents(target, listing['contents'])
+                elif listing.get('location', '').startswith('file://'):
+                    # the task may modify a writable entry: linking it would
+                    # modify the original too
+                    stager = self.workflow.copier if listing.get('writable') else self.workflow.stager
+                    stager.stage(listing['location'][7:], target)
+                else:
+                    raise WorkflowException("Unsupported location %s for %s in the working directory of %s" % (
+                        listing.get('location'), listing['basename'], id))
+            else:
+                log.warning('%s %s is not staged in the working directory of %s' % (
+                    listing['class'], listing.get('basename'), id))
 
         output_path = self.workflow.config.get('outloc', "output")
 
-        log.debug('SPEC_OUTPUTS: ' + pformat(self.spec['outputs']))
+        log.debug('SPEC_OUTPUTS: %s', logs.Pretty(self.spec['outputs']))
         outputs = {output['id'].replace(id + '#', '') :
                    output['outputBinding']['glob'] for output in self.spec['outputs'] if 'outputBinding' in output}
-        log.debug('PRE_OUTPUTS: ' + pformat(outputs))
+        log.debug('PRE_OUTPUTS: %s', logs.Pretty(outputs))
 
         stdout_path=self.spec.get('stdout', None)
         stderr_path=self.spec.get('stderr', None)
@@ -230,6 +346,10 @@ class LocalWorkflowJob(WorkflowJob):
 
         container = self.find_docker_requirement()
 
+        self.call = self.call_key(container, self.input_digests())
+        if self.reuse(self.call, self.local_path._abs("")):
+            return
+
         task = self.workflow.create_task(
             container=container,
             command=self.command_line,
@@ -242,34 +362,103 @@ class LocalWorkflowJob(WorkflowJob):
             stdout=stdout
         )
 
-        log.debug("TASK: " + pformat(task))
+        log.debug('TASK: %s', logs.Pretty(task))
 
-        task_id = self.workflow.service.submit(task)
-        operation = self.workflow.service.get_job(task_id)
         collected = {output: {'location': "fs://output/" + outputs[output], 'class': 'File'} for output in outputs}
+        log.debug('COLLECTED: %s', logs.Pretty(collected))
+
+        task_id = self.workflow.previous_task(self)
+        if task_id is not None:
+            log.info('Re-attaching %s to task %s' % (id, task_id))
+            self.submitted(task_id, collected)
+            return
+
+        self.workflow.batcher.submit(
+            task,
+            callback=lambda task_id: self.submitted(task_id, collected),
+            errback=self.submitFailed
+        )
+
+    def input_digests(self):
+        """
+        Returns what identifies the contents of the inputs of the job, for
+        the call cache: inputs staged in the content store are named after
+        their key, the local ones are digested. Returns None if an input is
+        neither, since its contents cannot be told: the job is not cached.
+        """
+        if self.workflow.callcache is None:
+            return None
+        digests = {}
+        for location, ent in self.pathmapper.items():
+            if ent.resolved.startswith("fs://cas/"):
+                digests[location] = ent.resolved
+            elif ent.resolved.startswith(self.local_path.protocol()):
+                path = ent.resolved[len(self.local_path.protocol()):]
+                digests[location] = self.local_path.checksum(path)
+            else:
+                return None
+        listing = [(l['basename'], l.get('contents', l.get('location')))
+                   for l in self.generatefiles['listing']]
+        return {'files': digests, 'listing': listing}
 
-        log.debug("OPERATION: " + pformat(operation))
-        log.debug('COLLECTED: ' + pformat(collected))
+    def submitted(self, task_id, collected):
+        id = self.spec['id']
+        operation = {'jobId': task_id}
+        log.debug('OPERATION: %s', logs.Pretty(operation))
+        self.workflow.job_submitted(self, task_id)
 
         monitor = LocalWorkflowMonitor(
             service=self.workflow.service,
             operation=operation,
             outputs=collected,
-            callback=self.jobCleanup
+            callback=self.jobCleanup,
+            errback=self.pollFailed,
+            tool_id=id,
+            runtime_hint=self.workflow.runtime_hint(id, file_bytes(self.joborder)),
+            **self.workflow.poll_options
         )
 
-        self.workflow.add_thread(monitor)
-        monitor.start()
+        self.workflow.add_monitor(monitor)
+
+    def submitFailed(self, error):
+        log.error('Submission of %s failed: %s' % (self.spec['id'], error))
+        self.jobFailed()
+
+    def pollFailed(self, error):
+        log.error('Lost track of %s: %s' % (self.spec['id'], error))
+        self.jobFailed()
 
+    def jobFailed(self):
+        self.output_callback({}, 'permanentFail')
+        self.workflow.notify_progress()
+
+    @tracing.traced('collect_outputs')
     def jobCleanup(self, operation, outputs):
-        log.debug('OPERATION: ' + pformat(operation))
-        log.debug('OUTPUTS: ' + pformat(outputs))
+        log.debug('OPERATION: %s', logs.Pretty(operation))
+        log.debug('OUTPUTS: %s', logs.Pretty(outputs))
         # log.debug('CWL_OUTPUT_PATH: ' + pformat(self.local_path._abs("cwl.output.json")))
 
+        # outputs of a failed task are never collected: its globs may match
+        # files left by other tasks, which must not be reported (or cached,
+        # or journaled) as its outputs
+        if operation.get('state') != 'Complete':
+            log.error('Task %s of %s ended in state %s' % (
+                operation.get('jobId'), self.spec['id'], operation.get('state')))
+            self.jobFailed()
+            return
+
+        # the task is complete: its outputs will not change anymore, and
+        # (if enabled) what is read of them can be cached
+        fs = self.local_path.cached() if self.workflow.listing_cache else self.local_path
+
         final = {}
-        if self.local_path.exists("work/cwl.output.json"):
+        digest = {}
+        # output files to keep in the call cache; None if they are not known
+        files = []
+        if fs.exists("work/cwl.output.json"):
+            files = None
             log.debug("Found cwl.output.json file")
-            with self.local_path.open("work/cwl.output.json", 'r') as args:
+            with fs.open("work/cwl.output.json", 'r') as args:
                 cwl_output = json.loads(args.read())
             final.update(cwl_output)
         else:
@@ -278,29 +467,72 @@ class LocalWorkflowJob(WorkflowJob):
                 if isinstance(type, dict):
                     if 'type' in type:
                         if type['type'] == 'array':
-                            with self.local_path.open("work/cwl.output.json", 'r') as args:
+                            with fs.open("work/cwl.output.json", 'r') as args:
                                 final = json.loads(args.read())
+                            files = None
                 elif type == 'File':
                     id = output['id'].replace(self.spec['id'] + '#', '')
                     binding = output['outputBinding']['glob']
-                    glob = self.local_path.glob(binding)
-                    log.debug('GLOB: ' + pformat(glob))
-                    with self.local_path.open(glob[0], 'rb') as handle:
-                        contents = handle.read()
-                        size = len(contents)
-                        checksum = hashlib.sha1(contents)
-                        hex = "sha1$%s" % checksum.hexdigest()
-
+                    glob = fs.glob(binding)
+                    if files is not None:
+                        files.append(glob[0])
+                    log.debug('GLOB: %s', logs.Pretty(glob))
                     collect = {
                         'location': os.path.basename(glob[0]),
                         'class': 'File',
-                        'size': size,
-                        'checksum': hex
+                        'size': fs.size(glob[0])
                     }
+                    # without a checksum here, cwltool computes it (if asked
+                    # to) on the final outputs only
+                    if self.workflow.compute_checksums:
+                        checksum = fs.cached_checksum(glob[0])
+                        if checksum is not None:
+                            collect['checksum'] = checksum
+                        else:
+                            digest[id] = glob[0]
 
                     final[id] = collect
 
-        self.output_callback(final, 'success')
+        if digest and self.workflow.digests is not None:
+            # the job is not over until its checksums are in
+            self.workflow.hold()
+
+            def digested(checksums):
+                tracing.end('digest', self.name, cat='task')
+                try:
+                    for id, checksum in checksums.items():
+                        final[id]['checksum'] = checksum
+                        fs.record_checksum(digest[id], checksum)
+                    self.jobDone(final, files)
+                except Exception:
+                    log.exception('Unable to complete %s once its outputs were digested' % (self.name))
+                    self.jobFailed()
+                finally:
+                    self.workflow.release()
+
+            tracing.begin('digest', self.name, cat='task')
+            self.workflow.digests.checksums(digest, digested)
+        else:
+            for id, path in digest.items():
+                final[id]['checksum'] = fs.checksum(path)
+            self.jobDone(final, files)
+
+    def jobDone(self, final, files=None):
+        if self.call is None or files is None:
+            self.output_callback(final, 'success')
+            return
+
+        # the job is over once its outputs are cached, since the tasks it
+        # unblocks may rewrite them
+        self.workflow.hold()
+
+        def cached():
+            try:
+                self.output_callback(final, 'success')
+            finally:
+                self.workflow.release()
+
+        self.workflow.callcache.put_async(self.call, final, files, cached)
 
     def output2location(self, path):
         return "fs://output/" + os.path.basename(path)
@@ -309,9 +541,10 @@ class LocalWorkflowJob(WorkflowJob):
         return "/mnt/" + path
 
 
-class LocalWorkflowMonitor(MonitorThread):
-    def __init__(self, service, operation, outputs, callback):
-        super(LocalWorkflowMonitor, self).__init__(operation)
+class LocalWorkflowMonitor(Monitor):
+    def __init__(self, service, operation, outputs, callback, **kwargs):
+        super(LocalWorkflowMonitor, self).__init__(operation, **kwargs)
+        self.id = operation['jobId']
         self.service = service
         self.outputs = outputs
         self.callback = callback
@@ -325,3 +558,6 @@ class LocalWorkflowMonitor(MonitorThread):
     def complete(self, operation):
         self.callback(operation, self.outputs)
 
+    def state(self, operation):
+        return operation.get('state')
+
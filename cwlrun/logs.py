@@ -0,0 +1,56 @@
+import logging
+from pprint import pformat
+
+SCALARS = (basestring, int, long, float, bool, type(None))
+
+class Pretty(object):
+    '''
+    Pretty-prints 'value' with pprint.pformat() only when converted to a
+    string, i.e. when a record it is an argument of is actually emitted:
+    log.debug('SPEC: %s', Pretty(spec)) costs nothing above DEBUG level.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pformat(self.value)
+
+class Fields(object):
+    '''
+    Renders the fields of an event as 'key=value' pairs, sorted by key, when
+    converted to a string; values other than scalars are pretty-printed.
+    '''
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('%s=%s' % (k, v if isinstance(v, SCALARS) else pformat(v))
+                        for k, v in sorted(self.fields.items()))
+
+class EventLogger(logging.LoggerAdapter):
+    '''
+    A logger that, besides the usual methods, logs structured events: a name
+    and keyword fields, formatted only if the event is emitted. The fields
+    are also attached to the record (as record.event and record.fields), for
+    handlers that want them unformatted.
+    '''
+    def __init__(self, logger):
+        logging.LoggerAdapter.__init__(self, logger, {})
+
+    def event(self, level, event, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, '%s %s', event, Fields(fields),
+                            extra={'event': event, 'fields': fields})
+
+    def debug_event(self, event, **fields):
+        self.event(logging.DEBUG, event, **fields)
+
+    def info_event(self, event, **fields):
+        self.event(logging.INFO, event, **fields)
+
+def get_logger(name='cloud_provision'):
+    return EventLogger(logging.getLogger(name))
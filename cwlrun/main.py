@@ -1,32 +1,68 @@
+import os
 import sys
+import glob
 import logging
 import signal
-import pkg_resources
-import yaml
-
-import cwltool.main
 
 from __init__ import __version__
-from local_wf import LocalWorkflow
-from command_line import CommandLineWorkflow
 
 log = logging.getLogger('cloud_provision')
 log.setLevel(logging.INFO)
 console = logging.StreamHandler()
 log.addHandler(console)
 
+def cwltool_version():
+    '''
+    Returns the version of the installed cwltool, read from the package
+    metadata next to it: importing pkg_resources scans every installed
+    distribution, which is most of the start-up time of '--version'.
+    '''
+    try:
+        import cwltool
+    except ImportError:
+        return "unknown"
+    site = os.path.dirname(os.path.dirname(os.path.abspath(cwltool.__file__)))
+    candidates = (glob.glob(os.path.join(site, 'cwltool*.dist-info', 'METADATA')) +
+                  glob.glob(os.path.join(site, 'cwltool*.egg-info', 'PKG-INFO')) +
+                  [p for p in glob.glob(os.path.join(site, 'cwltool*.egg-info')) if os.path.isfile(p)])
+    for path in candidates:
+        try:
+            with open(path) as handle:
+                for line in handle:
+                    if line.startswith('Version:'):
+                        return line.split(':', 1)[1].strip()
+        except (IOError, OSError):
+            continue
+    return "unknown"
+
 def versionstring():
-    pkg = pkg_resources.require("cwltool")
-    if pkg:
-        cwltool_ver = pkg[0].version
-    else:
-        cwltool_ver = "unknown"
-    return "%s %s with cwltool %s" % (sys.argv[0], __version__, cwltool_ver)
+    return "%s %s with cwltool %s" % (sys.argv[0], __version__, cwltool_version())
+
+def version_requested(args):
+    '''
+    Returns True if '--version' is given before the CWL document, i.e. to
+    cwlrun rather than as an input of the workflow. The scan stops at the
+    first argument not starting with '-', which may also be the value of an
+    option: a '--version' after it is then left to the full parser.
+    '''
+    for arg in args:
+        if arg == '--version':
+            return True
+        if arg == '--' or not arg.startswith('-'):
+            return False
+    return False
 
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
+    # answered before importing cwltool, which only the other modes need
+    if version_requested(args):
+        print(versionstring())
+        return 0
+
+    import cwltool.main
+
     parser = cwltool.main.arg_parser()
     parser = add_args(parser)
     newargs = parser.parse_args(args)
@@ -47,19 +83,38 @@ def main(args=None):
     if newargs.debug:
         log.setLevel(logging.DEBUG)
 
+    if newargs.restart and newargs.journal is None:
+        print("--restart requires the --journal of the run to restart")
+        return 1
+    options = {'journal': newargs.journal, 'restart': newargs.restart}
+    if newargs.history is not None:
+        options['history'] = newargs.history
+    if newargs.trace is not None:
+        options['trace'] = newargs.trace
+    if newargs.metrics_port is not None:
+        options['metrics_port'] = newargs.metrics_port
+
+    # backends (and their dependencies: requests, the tes client) are only
+    # imported once selected
     # TODO: remove
     if newargs.local is not None:
+        import yaml
+        from local_wf import LocalWorkflow
         with open(newargs.local) as handle:
             config = yaml.load(handle.read())
+            config.update(options)
             workflow = LocalWorkflow(config, newargs)
     # TODO: remove
     elif newargs.local_configs is not None and len(newargs.local_configs):
+        from local_wf import LocalWorkflow
         d = {}
         for k, v in newargs.local_configs:
             d[k] = v
+        d.update(options)
         workflow = LocalWorkflow(d, newargs)
     else:
-        workflow = CommandLineWorkflow({})
+        from command_line import CommandLineWorkflow
+        workflow = CommandLineWorkflow(dict(options, tes=newargs.tes))
 
             # setup signal handler
     def signal_handler(*args):
@@ -71,7 +126,7 @@ def main(args=None):
         )
         log.warning(
             "Running processes %s may keep running" %
-            ([t.id for t in workflow.threads])
+            (workflow.running_jobs())
         )
         sys.exit(1)
 
@@ -89,6 +144,18 @@ def main(args=None):
 
 def add_args(parser):
     parser.add_argument("--local", default=None, help="Task Execution on Local System")
+    parser.add_argument("--tes", default=None, help="Submit the steps as tasks to the TES endpoint at this URL")
+    parser.add_argument("--journal", default=None,
+                        help="Record the submitted and completed jobs in this file")
+    parser.add_argument("--restart", default=False, action="store_true",
+                        help="Restart the run recorded in --journal: completed jobs are skipped, "
+                        "running ones are re-attached to")
+    parser.add_argument("--history", default=None,
+                        help="Record the runtimes of the tools in this file, and predict from it")
+    parser.add_argument("--trace", default=None,
+                        help="Write a Chrome trace (chrome://tracing, Perfetto) of the run to this file")
+    parser.add_argument("--metrics-port", dest="metrics_port", default=None, type=int,
+                        help="Serve Prometheus metrics of the run on http://127.0.0.1:PORT/metrics")
     parser.add_argument("-t", dest="local_configs", default=None, action="append", nargs=2)
     return parser
 
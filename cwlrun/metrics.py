@@ -0,0 +1,233 @@
+import bisect
+import logging
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+log = logging.getLogger('cloud_provision')
+
+# buckets (in seconds) of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for n, v in pairs)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric(object):
+    '''
+    Base of the metric types: a metric with 'labels' has one child per
+    combination of label values, returned by labels(*values) (and best
+    looked up once, outside hot paths).
+    '''
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def samples(self):
+        children = list(self.children.items())
+        if not self.label_names and not children:
+            children = [((), self.labels())]
+        for values, child in sorted(children):
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, format_labels(self.label_names, values, extra), value
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines)
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if REGISTRY.enabled:
+            with self.lock:
+                self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), registry=None):
+        if not name.endswith('_total'):
+            name += '_total'
+        super(Counter, self).__init__(name, help, labels, registry)
+
+    def child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class GaugeChild(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        if REGISTRY.enabled:
+            with self.lock:
+                self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        '''
+        Makes the gauge report function() when scraped, instead of a value
+        updated on the hot path.
+        '''
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [('', (), value)]
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        if REGISTRY.enabled:
+            i = bisect.bisect_left(self.buckets, value)
+            with self.lock:
+                self.counts[i] += 1
+                self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], counts):
+            cumulative += count
+            samples.append(('_bucket', (('le', format_value(bound)),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labels, registry)
+
+    def child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+class Registry(object):
+    '''
+    The metrics of the process. Nothing is recorded until enable() is called,
+    so that metrics cost a single attribute check when they are not wanted.
+    '''
+    def __init__(self):
+        self.metrics = []
+        self.enabled = False
+        self.server = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def enable(self):
+        self.enabled = True
+
+    def expose(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        return '\n'.join(m.expose() for m in self.metrics) + '\n'
+
+    def serve(self, port, addr='127.0.0.1'):
+        '''
+        Enables the registry and serves it on http://addr:port/metrics from a
+        daemon thread. Returns the port (useful with port 0).
+        '''
+        self.enable()
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.expose()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((addr, int(port)), Handler)
+        t = threading.Thread(target=self.server.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        log.info('Serving metrics on http://%s:%d/metrics' % (addr, self.server.server_address[1]))
+        return self.server.server_address[1]
+
+REGISTRY = Registry()
+
+def serve(port, addr='127.0.0.1'):
+    return REGISTRY.serve(port, addr)
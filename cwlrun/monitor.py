@@ -1,31 +1,162 @@
+import time
+import random
 import threading
 import logging
 
+import tracing
+import metrics
+
 log = logging.getLogger('cloud_provision')
 
-class MonitorThread(threading.Thread):
+POLL_LATENCY = metrics.Histogram(
+    'cwlrun_poll_latency_seconds', 'Time taken to retrieve the state of a job')
+POLL_ERRORS = metrics.Counter('cwlrun_poll_errors', 'Failed polls of job states')
+
+class PollBackoff(object):
     '''
-    This class is intended to be used as a monitoring thread: it is responsible
-    for polling the task executor and retrieve information about execution
-    state and exit status.
+    Adaptive polling policy: polls start every 'initial' seconds and back off
+    exponentially by 'factor' up to 'maximum', with a random jitter of
+    +/- 'jitter' (as a fraction of the delay) so that jobs submitted together
+    do not poll together. If a runtime 'hint' (in seconds) is known for the
+    tool, delays never overshoot the expected end of the job.
     '''
-    def __init__(self, operation, poll_interval=1, poll_retries=10):
-        super(MonitorThread, self).__init__()
-        self.daemon = True
+    def __init__(self, initial=0.5, factor=1.5, maximum=120, jitter=0.1, hint=None):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.hint = hint
+        self.attempts = 0
+
+    def next_delay(self, elapsed):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        if delay < self.maximum:
+            self.attempts += 1
+        if self.hint is not None and elapsed < self.hint:
+            delay = min(delay, max(self.initial, self.hint - elapsed))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+class Monitor(object):
+    '''
+    This class holds the polling logic for a single operation submitted to the
+    task executor: how to retrieve its state, how to tell whether it is done
+    and what to do once it is. It does not own a thread: it is driven either by
+    a MonitorThread or by the shared JobPoller.
+
+    Polls are spaced according to a PollBackoff policy; up to 'poll_retries'
+    consecutive polling errors are tolerated before giving up, in which case
+    fail() hands the error to 'errback', so that the job can be failed.
+    '''
+    def __init__(self, operation, poll_interval=0.5, poll_retries=10,
+                 max_interval=120, jitter=0.1, runtime_hint=None, tool_id=None,
+                 errback=None):
         self.operation = operation
-        self.id = operation.id
+        self.id = getattr(operation, 'id', None)
+        self.tool_id = tool_id
         self.poll_interval = poll_interval
         self.poll_retries = poll_retries
+        self.backoff = PollBackoff(initial=poll_interval, maximum=max_interval,
+                                   jitter=jitter, hint=runtime_hint)
+        self.failures = 0
+        self.started = time.time()
         self.success = None
+        self.on_finish = None
+        self.errback = errback
+        self.traced = None
 
     def poll(self):
-        raise Exception('MonitorThread.poll() not implemented')
+        raise Exception('Monitor.poll() not implemented')
 
     def is_done(self, operation):
-        raise Exception('MonitorThread.is_done(operation) not implemented')
+        raise Exception('Monitor.is_done(operation) not implemented')
 
     def complete(self, operation):
-        raise Exception('MonitorThread.complete(operation) not implemented')
+        raise Exception('Monitor.complete(operation) not implemented')
+
+    def fail(self, error):
+        '''
+        Called instead of complete() when the operation cannot be followed
+        anymore (check() raised).
+        '''
+        if self.traced is not None:
+            self.trace_state(None)
+        if self.errback is not None:
+            self.errback(error)
+        else:
+            log.error('Job %s failed: %s' % (self.id, error))
+
+    def state(self, operation):
+        '''
+        Returns the state of the operation reported by the task executor
+        (e.g. queued, running), traced as a span while it lasts.
+        '''
+        return None
+
+    def trace_state(self, state):
+        if state == self.traced:
+            return
+        if self.traced is not None:
+            tracing.end(self.traced, self.id, cat='task')
+        if state is not None:
+            tracing.begin(state, self.id, cat='task')
+        self.traced = state
+
+    def check(self):
+        '''
+        Polls the operation once: if it is done, calls complete() and returns
+        True, otherwise returns False.
+        '''
+        started = time.time()
+        try:
+            with tracing.span('poll', job=self.id):
+                operation = self.poll()
+        except Exception as e:
+            POLL_ERRORS.inc()
+            self.failures += 1
+            if self.failures > self.poll_retries:
+                raise
+            log.warning('Polling job %s failed (%d/%d): %s' % (
+                self.id, self.failures, self.poll_retries, e))
+            return False
+        POLL_LATENCY.observe(time.time() - started)
+        self.failures = 0
+        done = self.is_done(operation)
+        if tracing.enabled():
+            self.trace_state(None if done else self.state(operation))
+        if not done:
+            return False
+        self.operation = operation
+        self.complete(operation)
+        return True
+
+    def next_delay(self):
+        return self.backoff.next_delay(self.elapsed())
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def finish(self):
+        # let the owner know this monitor is done, whatever the outcome
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+class MonitorThread(Monitor, threading.Thread):
+    '''
+    This class is intended to be used as a monitoring thread: it is responsible
+    for polling the task executor and retrieve information about execution
+    state and exit status.
+    '''
+    def __init__(self, operation, **kwargs):
+        threading.Thread.__init__(self)
+        Monitor.__init__(self, operation, **kwargs)
+        self.daemon = True
 
     def run(self):
-        raise Exception('MonitorThread.run() not implemented')
+        try:
+            while not self.check():
+                time.sleep(self.next_delay())
+        except Exception as e:
+            log.exception('Error while polling job %s' % (self.id))
+            self.fail(e)
+        finally:
+            self.finish()
@@ -0,0 +1,115 @@
+import time
+import heapq
+import threading
+import logging
+from itertools import count
+from Queue import Queue
+
+log = logging.getLogger('cloud_provision')
+
+# granularity of the dispatcher loop, in seconds
+TICK = 0.1
+
+class JobPoller(object):
+    '''
+    A single poller for all the outstanding jobs of a workflow. A dispatcher
+    thread hands the monitors due for polling to a fixed pool of worker
+    threads, at most 'max_rate' per second, so that neither the number of
+    threads nor the request rate towards the task executor grow with the
+    number of jobs. Each monitor decides when it wants to be polled next
+    (see Monitor.next_delay()).
+
+    Monitors are expected to implement the Monitor interface (check(),
+    next_delay(), fail(), finish()). A monitor is in flight from the moment
+    it is handed to a worker until it is scheduled again (or finished), so a
+    slow completion only holds up its own job. Threads are only started
+    when the first monitor is added.
+    '''
+    def __init__(self, workers=4, max_rate=100):
+        self.workers = workers
+        self.max_rate = max_rate
+        self.due = []
+        # monitors handed to a worker and not scheduled again yet
+        self.inflight = set()
+        self.seq = count()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.queue = Queue()
+        self.threads = []
+
+    def __len__(self):
+        with self.lock:
+            return len(self.due) + len(self.inflight)
+
+    def ids(self):
+        with self.lock:
+            return [m.id for (when, seq, m) in self.due] + [m.id for m in self.inflight]
+
+    def add(self, monitor):
+        self.schedule(monitor, time.time())
+        with self.lock:
+            if not self.threads:
+                self.start()
+        self.wakeup.set()
+
+    def schedule(self, monitor, when):
+        with self.lock:
+            self.inflight.discard(monitor)
+            heapq.heappush(self.due, (when, next(self.seq), monitor))
+
+    def start(self):
+        self.threads.append(threading.Thread(target=self.dispatch))
+        for i in range(self.workers):
+            self.threads.append(threading.Thread(target=self.work))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def dispatch(self):
+        batch_size = max(1, int(self.max_rate * TICK))
+        while True:
+            self.wakeup.clear()
+            started = time.time()
+            batch = []
+            with self.lock:
+                while (self.due and self.due[0][0] <= started and
+                       len(batch) < batch_size):
+                    monitor = heapq.heappop(self.due)[2]
+                    self.inflight.add(monitor)
+                    batch.append(monitor)
+            for monitor in batch:
+                self.queue.put(monitor)
+            with self.lock:
+                next_due = self.due[0][0] if self.due else None
+
+            # never go faster than 'max_rate', and sleep until the next
+            # monitor is due (or a new one is added)
+            time.sleep(max(0, TICK - (time.time() - started)))
+            if len(batch) < batch_size:
+                if next_due is None:
+                    self.wakeup.wait()
+                elif next_due > time.time():
+                    self.wakeup.wait(next_due - time.time())
+
+    def work(self):
+        while True:
+            self.poll(self.queue.get())
+
+    def poll(self, monitor):
+        try:
+            try:
+                done = monitor.check()
+            except Exception as e:
+                log.exception('Error while polling job %s' % (monitor.id))
+                monitor.fail(e)
+                done = True
+
+            if done:
+                with self.lock:
+                    self.inflight.discard(monitor)
+                monitor.finish()
+            else:
+                self.schedule(monitor, time.time() + monitor.next_delay())
+                self.wakeup.set()
+        except Exception:
+            log.exception('Error while completing job %s' % (monitor.id))
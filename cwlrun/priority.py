@@ -0,0 +1,107 @@
+import re
+import logging
+
+from cwltool.process import shortname
+
+log = logging.getLogger('cloud_provision')
+
+# suffix added by cwltool to the names of scattered (or repeated) jobs
+UNIQUE_SUFFIX = re.compile(r'_\d+$')
+
+class CriticalPath(object):
+    '''
+    Ranks the steps of a workflow by the length of the longest path from
+    each of them to the end of the workflow (themselves included), so that
+    the jobs on the critical path can be submitted first when not all the
+    ready ones can run.
+
+    The length of a step is its mean recorded runtime, as returned by
+    'runtime_hint(tool_id)'; steps never run before count as the mean of the
+    known ones (1 second if none is known). Steps of nested workflows are
+    ranked within them, plus the path following the nested workflow.
+    '''
+    def __init__(self, tool, runtime_hint):
+        self.tool = tool
+        self.runtime_hint = runtime_hint
+        # ranks by step name and, for jobs that cannot be matched by name, by
+        # tool id
+        self.ranks = {}
+        self.tools = {}
+        self.version = None
+
+    def refresh(self, version=None):
+        '''
+        Ranks the steps again, with the runtimes recorded so far, unless
+        already done for this 'version' (e.g. the number of completed jobs).
+        '''
+        if version is not None and version == self.version:
+            return
+        self.version = version
+        self.ranks = {}
+        self.tools = {}
+        known = []
+        self.collect(self.tool, known)
+        default = sum(known) / len(known) if known else 1.0
+        if getattr(self.tool, 'steps', None):
+            self.rank(self.tool, 0, default)
+
+    def collect(self, workflow, known):
+        for step in getattr(workflow, 'steps', []):
+            hint = self.runtime_hint(step.embedded_tool.tool.get('id'))
+            if hint is not None:
+                known.append(hint)
+            self.collect(step.embedded_tool, known)
+
+    def rank(self, workflow, offset, default):
+        '''
+        Ranks the steps of 'workflow', whose outputs are followed by a path of
+        length 'offset', and returns the length of its critical path.
+        '''
+        successors = {}
+        for step in workflow.steps:
+            successors[step.id] = []
+        for step in workflow.steps:
+            for inp in step.tool.get('inputs', []):
+                sources = inp.get('source', [])
+                if not isinstance(sources, list):
+                    sources = [sources]
+                for source in sources:
+                    for other in workflow.steps:
+                        if source.startswith(other.id + '/') and step.id not in successors[other.id]:
+                            successors[other.id].append(step.id)
+
+        steps = dict((step.id, step) for step in workflow.steps)
+        lengths = {}
+
+        def visit(step_id):
+            if step_id in lengths:
+                return lengths[step_id]
+            after = max([visit(s) for s in successors[step_id]] or [0])
+            embedded = steps[step_id].embedded_tool
+            tool_id = embedded.tool.get('id')
+            if getattr(embedded, 'steps', None):
+                length = after + self.rank(embedded, offset + after, default)
+            else:
+                runtime = self.runtime_hint(tool_id)
+                length = after + (runtime if runtime is not None else default)
+                name = shortname(step_id)
+                self.ranks[name] = max(self.ranks.get(name, 0), offset + length)
+                self.tools[tool_id] = max(self.tools.get(tool_id, 0), offset + length)
+            lengths[step_id] = length
+            return length
+
+        return max([visit(step_id) for step_id in steps] or [0])
+
+    def priority(self, job):
+        '''
+        Returns the heap key of 'job': the rank of the step it belongs to (0 if
+        unknown), with the resources it asks for as a tie-breaker, negated so
+        that the longest paths and then the largest jobs come first.
+        '''
+        name = getattr(job, 'name', None) or ''
+        rank = self.ranks.get(name, self.ranks.get(UNIQUE_SUFFIX.sub('', name)))
+        if rank is None:
+            spec = getattr(job, 'spec', None)
+            rank = self.tools.get(spec.get('id') if isinstance(spec, dict) else None, 0)
+        resources = getattr(getattr(job, 'builder', None), 'resources', None) or {}
+        return (-rank, -resources.get('cores', 0), -resources.get('ram', 0))
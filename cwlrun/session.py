@@ -0,0 +1,42 @@
+import logging
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    pass
+
+import metrics
+
+log = logging.getLogger('cloud_provision')
+
+HTTP_ERRORS = metrics.Counter(
+    'cwlrun_http_errors', 'HTTP replies with an error status from task services', ['code'])
+
+def count_errors(response, *args, **kwargs):
+    if response.status_code >= 400:
+        HTTP_ERRORS.labels(response.status_code).inc()
+
+def pooled_session(pool_size=16, retries=3):
+    """
+    Returns a keep-alive requests.Session with a connection pool of
+    'pool_size' connections, safe to share between threads. Failed
+    connections (and, for idempotent requests, 429 and 5xx replies) are
+    retried up to 'retries' times with exponential back-off. Error replies
+    are counted in the cwlrun_http_errors metric.
+    """
+    session = requests.Session()
+    session.hooks['response'].append(count_errors)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504)
+        )
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
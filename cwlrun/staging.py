@@ -0,0 +1,221 @@
+import os
+import errno
+import shutil
+import time
+import hashlib
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import metrics
+from io_utilities import ChecksumIndex, file_checksum
+
+log = logging.getLogger('cloud_provision')
+
+STAGED_BYTES = metrics.Counter('cwlrun_staged_bytes', 'Bytes of inputs staged', ['strategy'])
+STAGING_SECONDS = metrics.Counter(
+    'cwlrun_staging_seconds', 'Time spent staging inputs (staging throughput is '
+    'rate(cwlrun_staged_bytes_total) / rate(cwlrun_staging_seconds_total))', ['strategy'])
+
+# ioctl request to clone a whole file (btrfs, xfs, ...), from linux/fs.h
+FICLONE = 0x40049409
+COPY_BUFSIZE = 1024 * 1024
+CAS_DIR = 'cas'
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink not supported on this platform")
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+def symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+def copy(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+    shutil.copymode(src, dst)
+
+def same_contents(path, contents):
+    '''
+    Returns True if the file at 'path' holds exactly 'contents'.
+    '''
+    try:
+        if os.stat(path).st_size != len(contents):
+            return False
+        view = memoryview(contents)
+        offset = 0
+        with open(path, 'rb') as handle:
+            for block in iter(lambda: handle.read(COPY_BUFSIZE), b''):
+                if view[offset:offset + len(block)] != block:
+                    return False
+                offset += len(block)
+        return True
+    except (IOError, OSError):
+        return False
+
+def write_contents(path, contents):
+    '''
+    Writes 'contents' to 'path' with a single unbuffered write, unless the
+    file already holds the same bytes. Returns True if the file was written.
+
+    The contents are written to a temporary file renamed over 'path': if
+    'path' is a link to another file (e.g. staged by a Stager), the link is
+    replaced rather than the file it points to overwritten.
+    '''
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    if same_contents(path, contents):
+        return False
+    tmp = "%s.part-%d-%d" % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp, 'wb', 0) as handle:
+            handle.write(contents)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return True
+
+STRATEGIES = [
+    ('hardlink', hardlink),
+    ('reflink', reflink),
+    ('symlink', symlink),
+    ('copy', copy)
+]
+
+class Stager(object):
+    '''
+    Stages files into a shared store using the cheapest strategy that works,
+    in the order given by 'strategies' (names from STRATEGIES): hardlink,
+    reflink, symlink and, as a last resort, a byte copy.
+
+    The strategy that worked for a pair of (source, destination) filesystems
+    is remembered, so that following files between the same filesystems do
+    not retry the ones that already failed.
+    '''
+    def __init__(self, strategies=None):
+        if strategies is None:
+            self.strategies = STRATEGIES
+        else:
+            available = dict(STRATEGIES)
+            self.strategies = [(name, available[name]) for name in strategies]
+        self.selected = {}
+        self.lock = threading.Lock()
+
+    def stage(self, src, dst):
+        '''
+        Stages 'src' to 'dst', overwriting it, and returns the name of the
+        strategy used.
+        '''
+        if os.path.lexists(dst):
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                return 'existing'
+            os.remove(dst)
+
+        st = os.stat(src)
+        devices = (st.st_dev, os.stat(os.path.dirname(dst) or '.').st_dev)
+        with self.lock:
+            first = self.selected.get(devices, 0)
+
+        for i, (name, strategy) in enumerate(self.strategies[first:], first):
+            if name == 'hardlink' and devices[0] != devices[1]:
+                continue
+            started = time.time()
+            try:
+                strategy(src, dst)
+            except (IOError, OSError) as e:
+                log.debug('Staging %s with %s failed: %s' % (src, name, e))
+                continue
+            STAGED_BYTES.labels(name).inc(st.st_size)
+            STAGING_SECONDS.labels(name).inc(time.time() - started)
+            with self.lock:
+                self.selected[devices] = i
+            return name
+
+        raise IOError("Unable to stage %s to %s" % (src, dst))
+
+class ContentStore(object):
+    '''
+    A content-addressed staging area in the 'cas' directory of a shared store.
+    Each distinct input is staged once, as cas/<key>/<basename>, and reused by
+    every following step and run, so that files sharing a basename never
+    collide.
+
+    In 'stat' mode the key is derived from device, inode, size and mtime of the
+    source, which is cheap but only deduplicates the same source file; in
+    'content' mode it is the SHA-1 of the contents, which also deduplicates
+    copies of the same file. Content digests are recorded in a ChecksumIndex
+    ('index', by default cas/index), so that unchanged files are never hashed
+    twice. An entry named after contents must keep them: in 'content' mode
+    files are only reflinked or copied, since a hardlink or symlink would
+    change with the source if it is edited in place.
+
+    Entries are never removed by the driver: the store is a cache shared by
+    runs, to be cleared (e.g. rm -rf <base>/cas) when no run is using it.
+    '''
+    def __init__(self, base, stager=None, mode='stat', index=None):
+        self.root = os.path.join(base, CAS_DIR)
+        self.stager = stager if stager is not None else Stager()
+        if mode == 'content':
+            self.stager = Stager([name for name, strategy in self.stager.strategies
+                                  if name in ('reflink', 'copy')] or ['copy'])
+        self.mode = mode
+        self.locks = {}
+        self.lock = threading.Lock()
+        makedirs(self.root)
+        self.index = index if index is not None else ChecksumIndex(os.path.join(self.root, 'index'))
+
+    def stat_key(self, path):
+        return hashlib.sha1(self.index.key(os.stat(path))).hexdigest()
+
+    def key(self, path):
+        if self.mode != 'content':
+            return self.stat_key(path)
+        checksum = self.index.get(path)
+        if checksum is None:
+            checksum = file_checksum(path)
+            self.index.put(path, checksum)
+        return checksum.split('$', 1)[-1]
+
+    def stage(self, src):
+        '''
+        Stages 'src' (unless already staged) and returns its path relative to
+        the store base, together with the name of the strategy used.
+        '''
+        key = self.key(src)
+        name = os.path.join(CAS_DIR, key, os.path.basename(src))
+        dst = os.path.join(self.root, key, os.path.basename(src))
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            if os.path.exists(dst):
+                strategy = 'existing'
+            else:
+                makedirs(os.path.dirname(dst))
+                # stage under a temporary name, so that other processes never
+                # see a partial file
+                tmp = "%s.part-%d-%d" % (dst, os.getpid(), threading.current_thread().ident)
+                strategy = self.stager.stage(src, tmp)
+                os.rename(tmp, dst)
+        return name, strategy
@@ -0,0 +1,4 @@
+# upper bound on a single blocking wait (on a condition of the workflow, the
+# admission controller or the submit batcher), so that signals (e.g. ctrl+c)
+# are still delivered to the main thread while it waits
+WAIT_TIMEOUT = 1.0
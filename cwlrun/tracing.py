@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import functools
+import logging
+import threading
+
+log = logging.getLogger('cloud_provision')
+
+class Tracer(object):
+    '''
+    Collects timed spans in the Chrome trace event format, to be written to
+    'path' by write() and opened in chrome://tracing or Perfetto.
+
+    Spans on a single thread are 'complete' events; spans that start and end
+    on different threads (e.g. a task queued, then running, on the server)
+    are async events, grouped by an id.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.threads = {}
+        self.pid = os.getpid()
+        self.origin = time.time()
+
+    def now(self):
+        return int((time.time() - self.origin) * 1000000)
+
+    def thread(self):
+        current = threading.current_thread()
+        if current.ident not in self.threads:
+            self.threads[current.ident] = current.name
+        return current.ident
+
+    def complete(self, name, cat, start, args):
+        # list.append is atomic: no lock on the recording path
+        self.events.append({
+            'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': self.now() - start,
+            'pid': self.pid, 'tid': self.thread(), 'args': args
+        })
+
+    def async_event(self, phase, name, id, cat, args):
+        self.events.append({
+            'name': name, 'cat': cat, 'ph': phase, 'ts': self.now(), 'id': str(id),
+            'pid': self.pid, 'tid': self.thread(), 'args': args
+        })
+
+    def write(self):
+        events = list(self.events)
+        for ident, name in list(self.threads.items()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                           'tid': ident, 'args': {'name': name}})
+        with open(self.path, 'w') as handle:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, handle, default=str)
+        log.info('Trace of %d events written to %s' % (len(self.events), self.path))
+
+class Span(object):
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.cat, self.start, self.args)
+        return False
+
+class NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = NoSpan()
+
+# the active tracer, if any: when None every call below returns right away
+tracer = None
+
+def enable(path):
+    global tracer
+    tracer = Tracer(path)
+    return tracer
+
+def enabled():
+    return tracer is not None
+
+def span(name, cat='driver', **args):
+    '''
+    Returns a context manager timing its block as span 'name'.
+    '''
+    if tracer is None:
+        return NO_SPAN
+    return Span(tracer, name, cat, args)
+
+def traced(name, cat='driver'):
+    '''
+    Decorator tracing every call of the decorated function as span 'name'.
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with Span(tracer, name, cat, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def begin(name, id, cat='job', **args):
+    if tracer is not None:
+        tracer.async_event('b', name, id, cat, args)
+
+def end(name, id, cat='job', **args):
+    if tracer is not None:
+        tracer.async_event('e', name, id, cat, args)
+
+def write():
+    if tracer is not None:
+        tracer.write()
@@ -1,14 +1,57 @@
-import time
 import os
+import time
+import heapq
+import resource
 import tempfile
 import logging
+import threading
+from itertools import count
 
 from cwltool.errors import WorkflowException
 from cwltool.process import cleanIntermediate, relocateOutputs
 from cwltool.mutation import MutationManager
+from schema_salad.ref_resolver import uri_file_path
+
+from poller import JobPoller
+from admission import AdmissionController
+from journal import JobJournal
+from priority import CriticalPath
+from history import RuntimeHistory, file_bytes
+from timeouts import WAIT_TIMEOUT
+import tracing
+import metrics
 
 log = logging.getLogger('cloud_provision')
 
+# image of the jobs without a DockerRequirement
+DEFAULT_CONTAINER = "python:2.7"
+
+JOBS_IN_FLIGHT = metrics.Gauge('cwlrun_jobs_in_flight', 'Jobs admitted and not finished yet')
+JOBS_FINISHED = metrics.Counter('cwlrun_jobs_finished', 'Jobs finished', ['status'])
+OUTPUTS_COLLECTED = metrics.Counter('cwlrun_outputs_collected', 'Outputs collected from finished jobs')
+
+def optional(config, key, cast=int):
+    value = config.get(key)
+    if value is None or value == '':
+        return None
+    return cast(value)
+
+def children_usage():
+    '''
+    Returns the CPU time (in seconds) used by the child processes of the
+    driver waited for so far, and the peak RSS (in KB) of the largest one.
+    '''
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+def job_tool_id(job):
+    spec = getattr(job, 'spec', None)
+    return spec.get('id') if isinstance(spec, dict) else None
+
+def has_requirement(job, name):
+    reqs = (getattr(job, 'requirements', None) or []) + (getattr(job, 'hints', None) or [])
+    return any(r.get('class') == name for r in reqs)
+
 class WorkFlow(object):
     """
     This is a base class (should make it abstract?) for a WorkFlow, written in
@@ -17,8 +60,39 @@ class WorkFlow(object):
     has to provide, based on cwltool specifications.
     """
 
-    def __init__(self):
+    def __init__(self, config=None):
+        self.config = config if config is not None else {}
         self.threads = []
+        self.poller = JobPoller(
+            workers=int(self.config.get('poll_workers', 4)),
+            max_rate=float(self.config.get('poll_rate', 100))
+        )
+        self.poll_options = {
+            'poll_interval': float(self.config.get('poll_interval', 0.5)),
+            'max_interval': float(self.config.get('poll_max_interval', 120)),
+            'jitter': float(self.config.get('poll_jitter', 0.1))
+        }
+        self.admission = AdmissionController(
+            max_jobs=optional(self.config, 'max_jobs'),
+            max_cores=optional(self.config, 'max_cores', float),
+            max_ram=optional(self.config, 'max_ram', float),
+            rate=optional(self.config, 'submit_rate', float),
+            burst=optional(self.config, 'submit_burst', float)
+        )
+        # set by the subclasses that support call caching
+        self.callcache = None
+        if self.config.get('journal'):
+            self.journal = JobJournal(self.config['journal'], restart=bool(self.config.get('restart')))
+        else:
+            self.journal = None
+        self.sequence = count()
+        self.history = RuntimeHistory(self.config.get('history') or None)
+        if self.config.get('trace'):
+            tracing.enable(self.config['trace'])
+        JOBS_IN_FLIGHT.set_function(self.admission.running)
+        self.pending = 0
+        self.events = 0
+        self.finished = threading.Condition()
 
     def create_task(self, container, command, inputs, outputs, volumes, config):
         """
@@ -37,10 +111,13 @@ class WorkFlow(object):
         def output_callback(out, status):
             final_status.append(status)
             final_output.append(out)
+            self.notify_progress()
 
         if "basedir" not in kwargs:
             raise WorkflowException("Must provide 'basedir' in kwargs")
 
+        self.serve_metrics()
+
         output_dirs = set()
 
         if kwargs.get("outdir"):
@@ -77,7 +154,14 @@ class WorkFlow(object):
 
         jobs = tool.job(job_order, output_callback, **kwargs)
 
+        critical = CriticalPath(tool, self.runtime_hint)
+        # heap of the jobs ready to run, critical path first
+        ready = []
+
         try:
+            # 'seen' is taken before asking cwltool for the next step, so that
+            # a job completing in between is never missed
+            seen = self.events
             for runnable in jobs:
                 if runnable:
                     builder = kwargs.get("builder", None)
@@ -85,9 +169,20 @@ class WorkFlow(object):
                         runnable.builder = builder
                     if runnable.outdir:
                         output_dirs.add(runnable.outdir)
-                    runnable.run(**kwargs)
-                else:
-                    time.sleep(1)
+                    if getattr(runnable, 'output_callback', None) is None:
+                        # bookkeeping (e.g. cwltool WorkflowJob), not a job
+                        runnable.run(**kwargs)
+                    elif not self.replay(runnable):
+                        critical.refresh(self.events)
+                        heapq.heappush(ready, (critical.priority(runnable), next(self.sequence), runnable))
+                        self.dispatch(ready, kwargs)
+                elif not ready or not self.dispatch(ready, kwargs):
+                    self.wait_for_progress(seen, self.admission.delay() if ready else WAIT_TIMEOUT)
+                seen = self.events
+            while ready:
+                if not self.dispatch(ready, kwargs):
+                    self.wait_for_progress(seen, self.admission.delay())
+                seen = self.events
         except WorkflowException as e:
             raise e
         except Exception as e:
@@ -96,6 +191,9 @@ class WorkFlow(object):
 
         self.wait()
         log.info('All processes have joined')
+        if self.journal is not None:
+            self.journal.close()
+        tracing.write()
 
         if final_output and final_output[0] and finaloutdir:
             final_output[0] = relocateOutputs(
@@ -112,6 +210,16 @@ class WorkFlow(object):
             return (None, "permanentFail")
 
 
+    def serve_metrics(self):
+        """
+        Serves the metrics of the run, if a 'metrics_port' is configured.
+        Called when the run starts rather than by __init__(), so that the
+        serving thread is started after the processes subclasses fork while
+        being set up (e.g. the DigestPool of LocalWorkflow).
+        """
+        if self.config.get('metrics_port') and metrics.REGISTRY.server is None:
+            metrics.serve(int(self.config['metrics_port']))
+
     def make_exec_tool(self, spec, **kwargs):
         raise NotImplementedError("WorkFlow.make_exec_tool(): subclasses should implement this!")
 
@@ -120,12 +228,211 @@ class WorkFlow(object):
 
 
     def add_thread(self, thread):
-        self.threads.append(thread)
+        thread.on_finish = self.job_finished
+        with self.finished:
+            self.threads.append(thread)
+        self.hold()
 
-    def wait(self):
-        while True:
-            if all([not t.is_alive() for t in self.threads]):
+    def add_monitor(self, monitor):
+        """
+        Hands a monitor over to the shared poller, instead of starting a
+        thread for it.
+        """
+        monitor.on_finish = self.job_finished
+        self.hold()
+        self.poller.add(monitor)
+
+    def dispatch(self, ready, kwargs):
+        """
+        Runs the jobs of the 'ready' heap that the admission controller lets
+        in, in priority order, and returns the number of jobs started.
+        """
+        started = 0
+        while ready:
+            release = self.admit(ready[0][2])
+            if release is None:
                 break
+            runnable = heapq.heappop(ready)[2]
+            self.track(runnable)
+            try:
+                runnable.run(**kwargs)
+            except Exception:
+                release()
+                raise
+            started += 1
+        return started
+
+    def admit(self, runnable):
+        """
+        Admits 'runnable' if the admission controller lets it in, and hooks its
+        output_callback so that the slot is given back when the job is over.
+        Returns the release function, or None if the job cannot run yet.
+        """
+        builder = getattr(runnable, 'builder', None)
+        resources = getattr(builder, 'resources', None)
+        if resources is not None and not has_requirement(runnable, "ResourceRequirement"):
+            # cwltool defaults: better go by what the tool used in the past
+            predicted = self.history.resources(job_tool_id(runnable), file_bytes(getattr(runnable, 'joborder', None)))
+            resources = dict(resources, **predicted)
+        release = self.admission.try_acquire(resources)
+        if release is None:
+            return None
+        callback = runnable.output_callback
+
+        def output_callback(out, status):
+            release()
+            callback(out, status)
+
+        runnable.output_callback = output_callback
+        return release
+
+    def track(self, runnable):
+        """
+        Hooks the output_callback of 'runnable' so that, if it succeeds, its
+        runtime is recorded in the history (and traced, if tracing is on) and
+        its outputs are counted in the metrics.
+
+        CPU time and peak RSS are recorded for the jobs cwltool runs locally:
+        those complete synchronously, within run() on the dispatching thread,
+        so the usage of the children of the driver waited for in between is
+        theirs. Remote tasks do not report them.
+        """
+        tool_id = job_tool_id(runnable)
+        name = getattr(runnable, 'name', None)
+        tracing.begin('job', name, tool=tool_id)
+        input_bytes = file_bytes(getattr(runnable, 'joborder', None))
+        thread = threading.current_thread()
+        usage = children_usage()
+        started = time.time()
+        callback = runnable.output_callback
+
+        def output_callback(out, status):
+            tracing.end('job', name, status=status)
+            JOBS_FINISHED.labels(status).inc()
+            if out:
+                OUTPUTS_COLLECTED.inc(len(out))
+            if (tool_id is not None and status == 'success' and
+                    not getattr(runnable, 'cached', False)):
+                cpu = rss = None
+                if threading.current_thread() is thread:
+                    cpu_time, max_rss = children_usage()
+                    cpu = cpu_time - usage[0]
+                    # the peak RSS of the children is over all of them: it
+                    # only tells about this job if it grew
+                    if max_rss > usage[1]:
+                        rss = max_rss / 1024.0
+                self.history.record(tool_id, input_bytes, time.time() - started,
+                                    cpu=cpu, rss=rss, io=input_bytes + file_bytes(out))
+            callback(out, status)
+
+        runnable.output_callback = output_callback
+
+    def replay(self, runnable):
+        """
+        Completes 'runnable' with the outputs recorded in the journal, if a
+        previous run finished it, and returns True. Otherwise hooks its
+        output_callback, so that its completion is journaled, and returns False.
+        """
+        if self.journal is None:
+            return False
+        key = self.journal.job_key(runnable)
+        runnable.journal_key = key
+        outputs = self.journal.result(key)
+        if outputs is not None and self.outputs_exist(outputs):
+            log.info('Skipping %s, completed by a previous run' % (getattr(runnable, 'name', key)))
+            runnable.output_callback(outputs, 'success')
+            return True
+        callback = runnable.output_callback
+
+        def output_callback(out, status):
+            self.journal.done(key, out, status)
+            callback(out, status)
+
+        runnable.output_callback = output_callback
+        return False
+
+    def outputs_exist(self, outputs):
+        """
+        Returns False if a File or Directory in 'outputs' (e.g. recorded by a
+        previous run) no longer exists.
+        """
+        if isinstance(outputs, dict):
+            if outputs.get('class') in ('File', 'Directory') and 'location' in outputs:
+                if not self.output_exists(outputs['location']):
+                    return False
+            return all(self.outputs_exist(v) for v in outputs.values())
+        if isinstance(outputs, list):
+            return all(self.outputs_exist(v) for v in outputs)
+        return True
+
+    def output_exists(self, location):
+        if location.startswith('file://'):
+            return os.path.exists(uri_file_path(location))
+        return True
+
+    def job_submitted(self, job, task_id):
+        if self.journal is not None and getattr(job, 'journal_key', None) is not None:
+            self.journal.submitted(job.journal_key, task_id)
+
+    def previous_task(self, job):
+        """
+        Returns the id of the task submitted for 'job' by a previous run, and
+        possibly still running, or None.
+        """
+        if self.journal is None or getattr(job, 'journal_key', None) is None:
+            return None
+        return self.journal.task(job.journal_key)
+
+    def running_jobs(self):
+        return [t.id for t in self.threads if t.is_alive()] + self.poller.ids()
+
+    def job_finished(self, monitor):
+        """
+        Called by monitors when they are done (i.e. after the job
+        output_callback has run): wakes up wait() as soon as the last one
+        reports, and the executor whenever new steps may have become runnable.
+        """
+        self.release()
+
+    def hold(self):
+        """
+        Keeps wait() from returning until the matching release(): used for
+        monitors, and for work that completes a job asynchronously.
+        """
+        with self.finished:
+            self.pending += 1
+
+    def release(self):
+        with self.finished:
+            self.pending -= 1
+            self.events += 1
+            self.finished.notify_all()
+
+    def runtime_hint(self, tool_id, input_bytes=None):
+        """
+        Returns the mean runtime (in seconds) of the past jobs of the given
+        tool, with inputs of about 'input_bytes', or None if there are none.
+        """
+        return self.history.runtime(tool_id, input_bytes)
+
+    def notify_progress(self):
+        with self.finished:
+            self.events += 1
+            self.finished.notify_all()
+
+    def wait_for_progress(self, seen, timeout=WAIT_TIMEOUT):
+        """
+        Blocks until some job has reported since 'seen' was read from
+        self.events, or until timeout expires.
+        """
+        with self.finished:
+            if self.events == seen:
+                self.finished.wait(timeout)
+
+    def wait(self):
+        with self.finished:
+            while self.pending > 0:
+                self.finished.wait(WAIT_TIMEOUT)
         for t in self.threads:
             t.join()
 
@@ -136,20 +443,55 @@ class WorkflowJob(object):
         self.running = False
 
     def find_docker_requirement(self):
-        default = "python:2.7"
-        container = default
-        if self.workflow.kwargs["default_container"]:
-            container = self.workflow.kwargs["default_container"]
+        """
+        Returns the image of the DockerRequirement of the job, a requirement
+        taking precedence over a hint, or DEFAULT_CONTAINER if it has none.
+        The default container of the run is the first requirement of the
+        tool (see WorkFlow.executor()), so any other one overrides it.
+        """
+        requirements = getattr(self, 'requirements', None) or self.spec.get("requirements", [])
+        hints = getattr(self, 'hints', None) or self.spec.get("hints", [])
 
-        reqs = self.spec.get("requirements", []) + self.spec.get("hints", [])
-        for i in reqs:
+        container = DEFAULT_CONTAINER
+        for i in hints + requirements:
             if i.get("class", "NA") == "DockerRequirement":
                 container = i.get(
                     "dockerPull",
-                    i.get("dockerImageId", default)
+                    i.get("dockerImageId", container)
                 )
         return container
 
+    def call_key(self, container, inputs):
+        """
+        Returns the call cache key of the job, given its container and the
+        digests of its inputs, or None if the workflow has no call cache or
+        the inputs could not be digested.
+        """
+        if self.workflow.callcache is None or inputs is None:
+            return None
+        builder = getattr(self, 'builder', None)
+        return self.workflow.callcache.key(
+            self.spec, container, self.command_line, inputs,
+            getattr(builder, 'resources', None)
+        )
+
+    def reuse(self, key, outdir):
+        """
+        Completes the job with the outputs cached for 'key' (restored in
+        'outdir'), if any: returns True if it did, and the job must not be
+        submitted.
+        """
+        if key is None:
+            return False
+        outputs = self.workflow.callcache.get(key, outdir)
+        if outputs is None:
+            return False
+        log.info('Reusing the cached outputs of %s' % (self.spec.get('id')))
+        self.cached = True
+        self.output_callback(outputs, 'success')
+        self.workflow.notify_progress()
+        return True
+
     def run(self, pull_image=True, rm_container=True, rm_tmpdir=True,
             move_outputs="move", **kwargs):
         raise NotImplementedError("WorkflowJob.run(): subclasses should implement this!")
@@ -10,9 +10,19 @@ from . import BestAvZone, defaultType, defaultImage
 
 from utils import UserError, mean, std_dev
 from provisioning.aws import ec2_instance_types
+# served by begin.py, which imports it the same way
+from cwlrun import metrics
 
 log = logging.getLogger( "cloud_provision" )
 
+INSTANCES_REQUESTED = metrics.Counter(
+    'cloud_provision_instances_requested', 'EC2 instances requested', ['market'])
+INSTANCES_TERMINATED = metrics.Counter(
+    'cloud_provision_instances_terminated', 'EC2 instances terminated or stopped')
+INSTANCE_STARTUP = metrics.Histogram(
+    'cloud_provision_instance_startup_seconds', 'Time from request to running of on-demand instances',
+    buckets=(5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600))
+
 
 class UnexpectedResourceState( Exception ):
     def __init__( self, resource, to_state, state ):
@@ -76,6 +86,7 @@ def create_ec2_instances(env, imageId=defaultImage, count=1, instType=defaultTyp
         raise UserError("Cannot start any AWS service without an AWS object")
 
     log.info("Creating %s instance(s) using the key '%s'", str(count), keyName)
+    started = time.time()
     instances = env.ec2.create_instances(
         ImageId=imageId,
         MinCount=1,
@@ -86,6 +97,7 @@ def create_ec2_instances(env, imageId=defaultImage, count=1, instType=defaultTyp
         UserData=usr_data, #open("/shelf/fabio/lilWS/cloud_provision/init_scripts/sample_script.sh").read(),
         **other_opts
     )
+    INSTANCES_REQUESTED.labels('on_demand').inc(len(instances))
 
     #thread = threading.Thread(target=wait_running, args=(instances))
     #thread.start()
@@ -96,6 +108,7 @@ def create_ec2_instances(env, imageId=defaultImage, count=1, instType=defaultTyp
         inst.wait_until_running()
         inst.load()
         log.info("[%s] Instance %s is running.", inst.public_ip_address, inst.id)
+        INSTANCE_STARTUP.observe(time.time() - started)
 
     #thread.join()
 
@@ -155,6 +168,7 @@ def create_ec2_spot_instances(spot_price, env, imageId=defaultImage, count=1, se
         'SubnetId' : subnet,
         'UserData' : usr_data
     })
+    INSTANCES_REQUESTED.labels('spot').inc(count)
 
     return spot_response
 
@@ -181,10 +195,12 @@ def terminate_instance(env, instance_id=None):
             resp = inst.stop()
             log.info("Stopping instance %s" % resp['StoppingInstances'][0]['InstanceId'])
             stopped.append(resp['StoppingInstances'][0]['InstanceId'])
+        INSTANCES_TERMINATED.inc(len(stopped))
         return stopped
     else:
         log.info("Terminating instance %s" % instance_id)
         resp = env.ec2.Instance(instance_id).terminate()
+        INSTANCES_TERMINATED.inc()
         return resp['StoppingInstances'][0]['InstanceId']
 
 def wait_spot_requests_fullfilled( env, spot_req_id ):